@@ -51,10 +51,26 @@ with app.app_context():
     db.create_all()
     logger.info("Database tables created")
     
+    # Add columns and indexes that tables from older versions lack
+    from migrations import upgrade_schema
+    upgrade_schema()
+    
     # Initialize reminders
     from routes import init_reminders
     init_reminders()
     logger.info("Reminders initialized")
+    
+    # Ship n8n events queued before a restart
+    from n8n_integration import start_event_shipper
+    start_event_shipper()
+    
+    # Copy rows changed since the last run to Supabase every minute
+    from supabase_replication import start_replication
+    start_replication()
+    
+    # Keep connected calendars fresh so agenda views only read local data
+    from calendar_refresher import start_calendar_refresher
+    start_calendar_refresher()
 
 # Initialize bot if TELEGRAM_TOKEN is available
 telegram_token = os.environ.get("TELEGRAM_TOKEN")
@@ -0,0 +1,98 @@
+"""Measure the cost of getting a Calendar service object, before and after caching.
+
+Usage:
+    python benchmarks/bench_calendar_service.py --iterations 200
+
+Nothing goes over the network; only construction is measured. The runs are:
+
+    build        the old get_calendar_service: json.loads the stored token,
+                 build Credentials, then discovery.build, which reads and
+                 parses the discovery document every time
+    from doc     build_from_document with the discovery document parsed once
+                 and a shared AuthorizedHttp, as on a per-thread cache miss
+    cached       the per-thread service cache lookup used on every later call
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httplib2
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+STORED_TOKEN = json.dumps({
+    "token": "ya29.benchmark-token",
+    "refresh_token": "1//benchmark-refresh",
+    "token_uri": "https://oauth2.googleapis.com/token",
+    "client_id": "benchmark.apps.googleusercontent.com",
+    "client_secret": "benchmark-secret",
+    "scopes": ["https://www.googleapis.com/auth/calendar.readonly"],
+    "expiry": (datetime.utcnow() + timedelta(hours=1)).isoformat(),
+})
+
+
+def load_credentials():
+    data = json.loads(STORED_TOKEN)
+    return Credentials(
+        token=data["token"],
+        refresh_token=data["refresh_token"],
+        token_uri=data["token_uri"],
+        client_id=data["client_id"],
+        client_secret=data["client_secret"],
+        scopes=data["scopes"],
+        expiry=datetime.fromisoformat(data["expiry"]),
+    )
+
+
+def run(label, get_service, iterations):
+    get_service()
+    tracemalloc.start()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        get_service()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:9} {elapsed / iterations * 1000:8.3f} ms/call   peak {peak / 1024:8.0f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    def old():
+        return build("calendar", "v3", credentials=load_credentials(), cache_discovery=False)
+
+    document = json.loads(get_static_doc("calendar", "v3"))
+    credentials = load_credentials()
+    http = httplib2.Http(timeout=30)
+
+    def from_doc():
+        return build_from_document(document, http=AuthorizedHttp(credentials, http=http))
+
+    services = OrderedDict([(1, (credentials, from_doc()))])
+
+    def cached():
+        entry = services.get(1)
+        if entry is not None and entry[0] is credentials:
+            services.move_to_end(1)
+            return entry[1]
+        return from_doc()
+
+    run("build", old, args.iterations)
+    run("from doc", from_doc, args.iterations)
+    run("cached", cached, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
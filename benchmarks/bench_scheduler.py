@@ -0,0 +1,87 @@
+"""Compare thread count and memory of thread-per-reminder vs the heap scheduler.
+
+Usage:
+    python benchmarks/bench_scheduler.py --mode heap --count 100000
+    python benchmarks/bench_scheduler.py --mode threads --count 5000
+
+Run each mode in its own process so the numbers don't mix. The thread mode
+reproduces the old `reminder_thread_func` approach (one sleeping daemon
+thread per reminder) and usually can't reach 100k on a default ulimit.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import ReminderScheduler  # noqa: E402
+
+
+def read_memory():
+    """Return (VmRSS, VmSize) in MiB from /proc, or (None, None) if unavailable."""
+    values = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmSize:")):
+                    name, amount, _unit = line.split()
+                    values[name.rstrip(":")] = int(amount) / 1024
+    except OSError:
+        return None, None
+    return values.get("VmRSS"), values.get("VmSize")
+
+
+def noop():
+    pass
+
+
+def run_heap(count):
+    scheduler = ReminderScheduler(name="bench-scheduler")
+    scheduler.start()
+    now = datetime.utcnow()
+    started = time.perf_counter()
+    for i in range(count):
+        scheduler.schedule(i, now + timedelta(hours=1, seconds=i % 86400), noop)
+    elapsed = time.perf_counter() - started
+    return elapsed, len(scheduler)
+
+
+def run_threads(count):
+    started = time.perf_counter()
+    created = 0
+    for _ in range(count):
+        try:
+            threading.Thread(target=time.sleep, args=(3600,), daemon=True).start()
+        except RuntimeError as e:
+            print(f"Stopped after {created} threads: {e}")
+            break
+        created += 1
+    elapsed = time.perf_counter() - started
+    return elapsed, created
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["heap", "threads"], default="heap")
+    parser.add_argument("--count", type=int, default=100000)
+    args = parser.parse_args()
+
+    rss_before, vms_before = read_memory()
+    runner = run_heap if args.mode == "heap" else run_threads
+    elapsed, scheduled = runner(args.count)
+    rss_after, vms_after = read_memory()
+
+    print(f"mode:       {args.mode}")
+    print(f"scheduled:  {scheduled}")
+    print(f"time:       {elapsed:.3f}s ({scheduled / elapsed:,.0f}/s)")
+    print(f"threads:    {threading.active_count()}")
+    if rss_after is not None:
+        print(f"RSS:        {rss_after:.1f} MiB (+{rss_after - rss_before:.1f})")
+        print(f"VM size:    {vms_after:.1f} MiB (+{vms_after - vms_before:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Compare per-reminder commits with the batched write-back used by the dispatcher.
+
+Usage:
+    python benchmarks/bench_writeback.py --count 5000
+    python benchmarks/bench_writeback.py --url postgresql://localhost/adhd_bench
+
+The "before" run mirrors the old send_reminder: one SELECT, one UPDATE and
+one commit per reminder. The "after" run is _record_firings: one SELECT for
+the batch, then an executemany INSERT into the outbox and an executemany
+UPDATE of the reminders, committed once. Uses throwaway tables, so it doesn't
+need the Flask app.
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    Boolean, Column, DateTime, Integer, MetaData, String, Table, Text,
+    bindparam, create_engine, insert, select, update
+)
+
+metadata = MetaData()
+
+reminders = Table(
+    "bench_reminder", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("message", Text, nullable=False),
+    Column("scheduled_time", DateTime, nullable=False),
+    Column("repeat_interval", Integer),
+    Column("active", Boolean, default=True),
+    Column("last_sent_at", DateTime),
+    Column("lease_owner", String(64)),
+    Column("lease_expires_at", DateTime),
+)
+
+deliveries = Table(
+    "bench_reminder_delivery", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("idempotency_key", String(64), unique=True, nullable=False),
+    Column("reminder_id", Integer, nullable=False),
+    Column("message", Text, nullable=False),
+    Column("fire_time", DateTime, nullable=False),
+    Column("next_attempt_at", DateTime, nullable=False),
+)
+
+
+def reset(engine, count):
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        conn.execute(insert(reminders), [
+            {
+                "id": i,
+                "message": "Time to drink water!",
+                "scheduled_time": now,
+                "repeat_interval": 60 if i % 2 else None,
+                "active": True,
+            }
+            for i in range(1, count + 1)
+        ])
+
+
+def per_row(engine, ids, batch_size):
+    commits = 0
+    for reminder_id in ids:
+        with engine.begin() as conn:
+            row = conn.execute(select(reminders).where(reminders.c.id == reminder_id)).one()
+            now = datetime.utcnow()
+            conn.execute(insert(deliveries).values(
+                idempotency_key=f"{row.id}:{row.scheduled_time.isoformat()}",
+                reminder_id=row.id,
+                message=row.message,
+                fire_time=row.scheduled_time,
+                next_attempt_at=now,
+            ))
+            conn.execute(update(reminders).where(reminders.c.id == reminder_id).values(
+                last_sent_at=now,
+                scheduled_time=now + timedelta(minutes=row.repeat_interval) if row.repeat_interval else row.scheduled_time,
+                active=bool(row.repeat_interval),
+                lease_owner=None,
+                lease_expires_at=None,
+            ))
+        commits += 1
+    return commits
+
+
+def batched(engine, ids, batch_size):
+    stmt = update(reminders).where(reminders.c.id == bindparam("b_id")).values(
+        scheduled_time=bindparam("b_scheduled_time"),
+        active=bindparam("b_active"),
+        last_sent_at=bindparam("b_last_sent_at"),
+        lease_owner=None,
+        lease_expires_at=None,
+    )
+    commits = 0
+    for start in range(0, len(ids), batch_size):
+        chunk = ids[start:start + batch_size]
+        with engine.begin() as conn:
+            rows = conn.execute(select(reminders).where(reminders.c.id.in_(chunk))).all()
+            now = datetime.utcnow()
+            conn.execute(insert(deliveries), [
+                {
+                    "idempotency_key": f"{row.id}:{row.scheduled_time.isoformat()}",
+                    "reminder_id": row.id,
+                    "message": row.message,
+                    "fire_time": row.scheduled_time,
+                    "next_attempt_at": now,
+                }
+                for row in rows
+            ])
+            conn.execute(stmt, [
+                {
+                    "b_id": row.id,
+                    "b_scheduled_time": now + timedelta(minutes=row.repeat_interval) if row.repeat_interval else row.scheduled_time,
+                    "b_active": bool(row.repeat_interval),
+                    "b_last_sent_at": now,
+                }
+                for row in rows
+            ])
+        commits += 1
+    return commits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--url", help="database URL (defaults to a temporary SQLite file)")
+    args = parser.parse_args()
+
+    url = args.url
+    if not url:
+        url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    engine = create_engine(url)
+    ids = list(range(1, args.count + 1))
+
+    for name, runner in (("per-row", per_row), ("batched", batched)):
+        reset(engine, args.count)
+        started = time.perf_counter()
+        commits = runner(engine, ids, args.batch_size)
+        elapsed = time.perf_counter() - started
+        print(f"{name:8} {args.count} reminders, {commits} commits in {elapsed:.2f}s "
+              f"({commits / elapsed:,.0f} commits/s, {args.count / elapsed:,.0f} reminders/s)")
+
+    metadata.drop_all(engine)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,9 +10,12 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 
 from app import db
 from models import User, Task, Reminder, CalendarEvent
-from calendar_integration import get_upcoming_events
+from calendar_refresher import mark_user_active, is_calendar_stale, request_refresh
 from supabase_client import get_supabase_client
-from reminder_manager import schedule_reminder, send_reminder
+from reminder_manager import (
+    schedule_reminder, reschedule_reminder, cancel_reminder, send_reminder, wake_outbox_drain
+)
+from delivery import start_delivery_queue
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -48,8 +51,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "/list_tasks - List all your tasks\n"
         "/complete_task - Mark a task as complete\n"
         "/water_reminder - Set water reminders\n"
-        "/today - Show today's agenda\n"
-        "/tomorrow - Show tomorrow's agenda\n"
+        "/today - Show today's agenda (add 'refresh' to resync your calendar)\n"
+        "/tomorrow - Show tomorrow's agenda (add 'refresh' to resync your calendar)\n"
         "/reminders - Manage your reminders\n"
     )
 
@@ -371,6 +374,7 @@ async def water_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             if existing:
                 existing.active = False
                 db.session.commit()
+                cancel_reminder(existing.id)
                 await query.edit_message_text("Water reminders have been stopped.")
             else:
                 await query.edit_message_text("You don't have any water reminders set up.")
@@ -382,7 +386,12 @@ async def water_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if existing:
             existing.repeat_interval = minutes
             existing.active = True
+            existing.scheduled_time = datetime.utcnow() + timedelta(minutes=minutes)
             db.session.commit()
+            
+            # Supersede the timer for the old interval
+            reschedule_reminder(existing.id)
+            
             await query.edit_message_text(f"Water reminder updated to every {minutes} minutes!")
         else:
             # Create new water reminder
@@ -416,6 +425,10 @@ async def today(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await update.message.reply_text("Please register first with /register")
             return
         
+        # Before the queries below, since it commits and would expire what
+        # they load
+        mark_user_active(user)
+        
         today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
         today_end = today_start + timedelta(days=1)
         
@@ -434,21 +447,18 @@ async def today(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             CalendarEvent.start_time < today_end
         ).order_by(CalendarEvent.start_time).all()
         
-        # If user has Google Calendar connected, fetch latest events
+        # Events come from the local copy; if it's stale, or the user asked
+        # with "refresh", sync in the background instead of blocking the reply
+        refreshing = False
         if user.google_calendar_token:
-            try:
-                get_upcoming_events(user.id)
-                # Refresh events after sync
-                events = CalendarEvent.query.filter(
-                    CalendarEvent.user_id == user.id,
-                    CalendarEvent.start_time >= today_start,
-                    CalendarEvent.start_time < today_end
-                ).order_by(CalendarEvent.start_time).all()
-            except Exception as e:
-                logger.error(f"Failed to sync calendar: {e}")
+            refreshing = bool(context.args and context.args[0].lower() == "refresh")
+            if refreshing or is_calendar_stale(user.id):
+                request_refresh(user.id)
         
         # Build the agenda message
         message = "📅 TODAY'S AGENDA\n\n"
+        if refreshing:
+            message += "🔄 Refreshing your calendar in the background, check again in a moment.\n\n"
         
         if not tasks and not events:
             message += "Your schedule is clear for today! 🎉"
@@ -484,6 +494,10 @@ async def tomorrow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await update.message.reply_text("Please register first with /register")
             return
         
+        # Before the queries below, since it commits and would expire what
+        # they load
+        mark_user_active(user)
+        
         tomorrow_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
         tomorrow_end = tomorrow_start + timedelta(days=1)
         
@@ -502,21 +516,18 @@ async def tomorrow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             CalendarEvent.start_time < tomorrow_end
         ).order_by(CalendarEvent.start_time).all()
         
-        # If user has Google Calendar connected, fetch latest events
+        # Events come from the local copy; if it's stale, or the user asked
+        # with "refresh", sync in the background instead of blocking the reply
+        refreshing = False
         if user.google_calendar_token:
-            try:
-                get_upcoming_events(user.id)
-                # Refresh events after sync
-                events = CalendarEvent.query.filter(
-                    CalendarEvent.user_id == user.id,
-                    CalendarEvent.start_time >= tomorrow_start,
-                    CalendarEvent.start_time < tomorrow_end
-                ).order_by(CalendarEvent.start_time).all()
-            except Exception as e:
-                logger.error(f"Failed to sync calendar: {e}")
+            refreshing = bool(context.args and context.args[0].lower() == "refresh")
+            if refreshing or is_calendar_stale(user.id):
+                request_refresh(user.id)
         
         # Build the agenda message
         message = "📅 TOMORROW'S AGENDA\n\n"
+        if refreshing:
+            message += "🔄 Refreshing your calendar in the background, check again in a moment.\n\n"
         
         if not tasks and not events:
             message += "Your schedule is clear for tomorrow! 🎉"
@@ -626,6 +637,9 @@ async def reminder_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
             db.session.commit()
             
+            for reminder in reminders:
+                cancel_reminder(reminder.id)
+            
             await query.edit_message_text("All reminders have been paused.")
         
         elif action == "reminders_back":
@@ -655,12 +669,21 @@ async def reminder_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await query.edit_message_text(message, reply_markup=reply_markup)
 
 
+async def _start_delivery(app: Application) -> None:
+    """Start the rate-limited reminder delivery queue on the bot's event loop."""
+    start_delivery_queue(app.bot)
+    # Outbox rows are only claimed where the queue runs, so pick up any
+    # that piled up before the bot started
+    wake_outbox_drain()
+
+
 def initialize_bot(token):
     """Initialize and start the Telegram bot."""
     global application
     
-    # Create the Application and pass it your bot's token
-    application = Application.builder().token(token).build()
+    # Create the Application and pass it your bot's token. The delivery
+    # queue is started from post_init so it runs on the polling event loop.
+    application = Application.builder().token(token).post_init(_start_delivery).build()
     
     # Add command handlers
     application.add_handler(CommandHandler("start", start))
@@ -1,16 +1,29 @@
 import os
 import logging
 import json
-from datetime import datetime, timedelta
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
+import httplib2
 import requests
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
+from requests.adapters import HTTPAdapter
+from sqlalchemy import insert, update
 
 from app import db
-from models import User, CalendarEvent
+from models import User, CalendarEvent, CalendarSyncState
+from utils import TokenBucket
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -26,6 +39,45 @@ CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID')
 CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET')
 REDIRECT_URI = os.environ.get('GOOGLE_REDIRECT_URI', 'http://localhost:5000/oauth2callback')
 
+CALENDAR_HTTP_TIMEOUT = 30
+# Default days ahead to keep in sync; callers can ask for more or less
+CALENDAR_SYNC_DAYS = int(os.environ.get('CALENDAR_SYNC_DAYS', 14))
+CALENDAR_PAGE_SIZE = 250
+# Calendars fetched at once across all syncs in this process
+CALENDAR_FETCH_WORKERS = int(os.environ.get('CALENDAR_FETCH_WORKERS', 16))
+CALENDAR_QUEUE_TIMEOUT = 120
+# Calendar API requests per second for the whole process and for one user.
+# Google's default quota is 600 requests per minute per user.
+CALENDAR_QUOTA_RPS = float(os.environ.get('CALENDAR_QUOTA_RPS', 100))
+CALENDAR_USER_RPS = float(os.environ.get('CALENDAR_USER_RPS', 5))
+# Retries with exponential backoff on 429, rate limit 403s and 5xx
+CALENDAR_API_RETRIES = 3
+# Calendar services kept per thread, least recently used dropped first
+SERVICE_CACHE_SIZE = 256
+
+# CalendarEvent columns filled from the API, compared to skip unchanged rows
+EVENT_FIELDS = ('title', 'description', 'start_time', 'end_time', 'location')
+
+# Parsed discovery document, shared by every service
+_discovery_doc = None
+# user_id -> Credentials, shared by all threads
+_credentials_cache = {}
+_credentials_lock = threading.Lock()
+# user_id -> Lock held while that user's token is refreshed, so refreshes
+# for different users run in parallel
+_refresh_locks = {}
+# Pooled session for token refreshes, with room for one connection per
+# concurrent sync
+_token_session = requests.Session()
+_token_session.mount('https://', HTTPAdapter(pool_maxsize=CALENDAR_FETCH_WORKERS))
+# Per-thread httplib2 connection and services
+_local = threading.local()
+_fetch_pool = ThreadPoolExecutor(max_workers=CALENDAR_FETCH_WORKERS, thread_name_prefix="calendar-fetch")
+_quota_bucket = TokenBucket(CALENDAR_QUOTA_RPS)
+# user_id -> TokenBucket
+_user_buckets = {}
+_user_buckets_lock = threading.Lock()
+
 
 def create_oauth_flow():
     """Create OAuth flow for Google Calendar API."""
@@ -84,7 +136,22 @@ def process_oauth_callback(code, state):
         return False
     
     # Store credentials as JSON string
-    user.google_calendar_token = json.dumps({
+    user.google_calendar_token = _credentials_json(credentials)
+    
+    db.session.commit()
+    invalidate_calendar_service(user_id)
+    logger.info(f"Google Calendar connected for user {user_id}")
+    
+    # Sync calendar events in the background
+    from calendar_refresher import request_refresh
+    request_refresh(user_id)
+    
+    return True
+
+
+def _credentials_json(credentials):
+    """Serialize credentials the way they are stored on the user."""
+    return json.dumps({
         'token': credentials.token,
         'refresh_token': credentials.refresh_token,
         'token_uri': credentials.token_uri,
@@ -93,148 +160,451 @@ def process_oauth_callback(code, state):
         'scopes': credentials.scopes,
         'expiry': credentials.expiry.isoformat() if credentials.expiry else None
     })
+
+
+def _discovery_document():
+    """Load and parse the Calendar discovery document once per process."""
+    global _discovery_doc
     
-    db.session.commit()
-    logger.info(f"Google Calendar connected for user {user_id}")
-    
-    # Immediately sync calendar events
-    get_upcoming_events(user_id)
+    if _discovery_doc is None:
+        _discovery_doc = json.loads(get_static_doc(API_SERVICE_NAME, API_VERSION))
+    return _discovery_doc
+
+
+def _thread_http():
+    """Keep-alive httplib2 connection pool for the calling thread.
     
-    return True
+    httplib2.Http isn't thread-safe, so each thread gets its own, along with
+    its own service objects built on top of it.
+    """
+    http = getattr(_local, 'http', None)
+    if http is None:
+        http = _local.http = httplib2.Http(timeout=CALENDAR_HTTP_TIMEOUT)
+        _local.services = OrderedDict()
+    return http
 
 
-def get_calendar_service(user_id):
-    """Get Google Calendar service for a user."""
+def _load_credentials(user_id):
+    """Return cached credentials for a user, reading the stored token on a miss."""
+    with _credentials_lock:
+        credentials = _credentials_cache.get(user_id)
+    if credentials is not None:
+        return credentials
+    
     user = User.query.get(user_id)
     if not user or not user.google_calendar_token:
-        logger.error(f"User {user_id} not found or calendar not connected")
         return None
     
-    # Parse stored credentials
+    creds_data = json.loads(user.google_calendar_token)
+    
+    if creds_data.get('expiry'):
+        expiry = datetime.fromisoformat(creds_data['expiry'])
+    else:
+        expiry = None
+    
+    credentials = Credentials(
+        token=creds_data['token'],
+        refresh_token=creds_data['refresh_token'],
+        token_uri=creds_data['token_uri'],
+        client_id=creds_data['client_id'],
+        client_secret=creds_data['client_secret'],
+        scopes=creds_data['scopes'],
+        expiry=expiry
+    )
+    
+    with _credentials_lock:
+        return _credentials_cache.setdefault(user_id, credentials)
+
+
+def _refresh_if_needed(user_id, credentials):
+    """Refresh credentials that are expired or about to expire and store the new token."""
+    if credentials.valid or not credentials.refresh_token:
+        return
+    
+    with _credentials_lock:
+        refresh_lock = _refresh_locks.setdefault(user_id, threading.Lock())
+    
+    with refresh_lock:
+        # Another thread may have refreshed while we waited
+        if credentials.valid:
+            return
+        credentials.refresh(GoogleAuthRequest(_token_session))
+    
+    # The token isn't replicated, so keep updated_at as it is
+    User.query.filter_by(id=user_id).update(
+        {"google_calendar_token": _credentials_json(credentials), "updated_at": User.updated_at},
+        synchronize_session=False
+    )
+    db.session.commit()
+
+
+def invalidate_calendar_service(user_id):
+    """Forget cached credentials for a user, e.g. after they reconnect their calendar.
+    
+    Per-thread service objects hold the old credentials, so they are
+    rebuilt on their next use.
+    """
+    with _credentials_lock:
+        _credentials_cache.pop(user_id, None)
+        _refresh_locks.pop(user_id, None)
+
+
+def _service_for(user_id, credentials):
+    """Return this thread's service for the given credentials, building it on a miss.
+    
+    Doesn't touch the database, so it is safe on threads without an app
+    context.
+    """
+    http = _thread_http()
+    services = _local.services
+    cached = services.get(user_id)
+    if cached is not None and cached[0] is credentials:
+        services.move_to_end(user_id)
+        return cached[1]
+    
+    service = build_from_document(
+        _discovery_document(),
+        http=AuthorizedHttp(credentials, http=http)
+    )
+    services[user_id] = (credentials, service)
+    if len(services) > SERVICE_CACHE_SIZE:
+        services.popitem(last=False)
+    return service
+
+
+def get_calendar_service(user_id):
+    """Get Google Calendar service for a user.
+    
+    Credentials are cached per user and refreshed only when they are about
+    to expire. Services are built from a discovery document parsed once, on
+    a per-thread keep-alive connection, and reused across calls.
+    """
     try:
-        creds_data = json.loads(user.google_calendar_token)
-        
-        if creds_data.get('expiry'):
-            expiry = datetime.fromisoformat(creds_data['expiry'])
-        else:
-            expiry = None
-        
-        credentials = Credentials(
-            token=creds_data['token'],
-            refresh_token=creds_data['refresh_token'],
-            token_uri=creds_data['token_uri'],
-            client_id=creds_data['client_id'],
-            client_secret=creds_data['client_secret'],
-            scopes=creds_data['scopes'],
-            expiry=expiry
-        )
+        credentials = _load_credentials(user_id)
+        if credentials is None:
+            logger.error(f"User {user_id} not found or calendar not connected")
+            return None
         
-        # Check if credentials are expired and refresh if needed
-        if credentials.expired and credentials.refresh_token:
-            credentials.refresh(requests.Request())
-            
-            # Update stored credentials after refresh
-            user.google_calendar_token = json.dumps({
-                'token': credentials.token,
-                'refresh_token': credentials.refresh_token,
-                'token_uri': credentials.token_uri,
-                'client_id': credentials.client_id,
-                'client_secret': credentials.client_secret,
-                'scopes': credentials.scopes,
-                'expiry': credentials.expiry.isoformat() if credentials.expiry else None
-            })
-            db.session.commit()
-        
-        # Build and return the service
-        service = build(API_SERVICE_NAME, API_VERSION, credentials=credentials)
-        return service
+        _refresh_if_needed(user_id, credentials)
+        return _service_for(user_id, credentials)
+    
+    except RefreshError as e:
+        # The refresh token was revoked; the user has to reconnect
+        invalidate_calendar_service(user_id)
+        logger.error(f"Error refreshing calendar credentials for user {user_id}: {e}")
+        return None
     
     except Exception as e:
         logger.error(f"Error getting calendar service: {e}")
         return None
 
 
-def get_upcoming_events(user_id, days=14):
-    """Fetch upcoming events from Google Calendar and store in the database."""
+def _utc(value):
+    """Parse an RFC 3339 timestamp into a naive UTC datetime."""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _parse_event(event):
+    """Extract CalendarEvent fields from a Calendar API event."""
+    start = event.get('start', {})
+    end = event.get('end', {})
+    
+    if 'dateTime' in start:
+        # This is a timed event. Store it as naive UTC, like every other
+        # DateTime column, so values read back compare equal to freshly
+        # parsed ones and to utcnow() whatever the calendar's time zone.
+        start_time = _utc(start['dateTime'])
+        end_time = _utc(end['dateTime'])
+    else:
+        # This is an all-day event
+        start_time = datetime.fromisoformat(start['date'])
+        end_time = datetime.fromisoformat(end['date'])
+    
+    return {
+        'title': event.get('summary', 'Unnamed event'),
+        'description': event.get('description', ''),
+        'start_time': start_time,
+        'end_time': end_time,
+        'location': event.get('location', '')
+    }
+
+
+def _apply_events(user_id, calendar_id, events):
+    """Insert, update or delete the local copies of a page of events.
+    
+    Existing rows are loaded with one IN query and compared field by field,
+    so only new and changed events are written: one bulk insert, one bulk
+    update and one delete per page, however many events it has.
+    """
+    cancelled = set()
+    fetched = {}
+    for event in events:
+        # Deleted events only appear in incremental results, as cancelled stubs
+        if event.get('status') == 'cancelled':
+            cancelled.add(event['id'])
+            fetched.pop(event['id'], None)
+        else:
+            cancelled.discard(event['id'])
+            fetched[event['id']] = _parse_event(event)
+    
+    existing = {}
+    if fetched:
+        existing = {
+            row.google_event_id: row for row in db.session.query(
+                CalendarEvent.id, CalendarEvent.google_event_id, *[
+                    getattr(CalendarEvent, name) for name in EVENT_FIELDS
+                ]
+            ).filter(
+                CalendarEvent.user_id == user_id,
+                CalendarEvent.calendar_id == calendar_id,
+                CalendarEvent.google_event_id.in_(fetched)
+            )
+        }
+    
+    now = datetime.utcnow()
+    inserts = []
+    updates = []
+    for google_event_id, fields in fetched.items():
+        row = existing.get(google_event_id)
+        if row is None:
+            inserts.append(dict(
+                fields,
+                google_event_id=google_event_id,
+                calendar_id=calendar_id,
+                user_id=user_id,
+                synced_at=now
+            ))
+        elif any(getattr(row, name) != value for name, value in fields.items()):
+            updates.append(dict(fields, id=row.id, synced_at=now))
+    
+    if inserts:
+        db.session.execute(insert(CalendarEvent), inserts)
+    if updates:
+        db.session.execute(update(CalendarEvent), updates)
+    if cancelled:
+        CalendarEvent.query.filter(
+            CalendarEvent.user_id == user_id,
+            CalendarEvent.calendar_id == calendar_id,
+            CalendarEvent.google_event_id.in_(cancelled)
+        ).delete(synchronize_session=False)
+    
+    return len(inserts), len(updates), len(cancelled)
+
+
+def _sync_state(user_id, calendar_id):
+    state = CalendarSyncState.query.filter_by(user_id=user_id, calendar_id=calendar_id).first()
+    if state is None:
+        state = CalendarSyncState(user_id=user_id, calendar_id=calendar_id)
+        db.session.add(state)
+    return state
+
+
+def _user_bucket(user_id):
+    with _user_buckets_lock:
+        bucket = _user_buckets.get(user_id)
+        if bucket is None:
+            # Drop buckets for users not synced lately so the map stays small
+            if len(_user_buckets) > 10000:
+                for key in [key for key, value in _user_buckets.items() if value.idle()]:
+                    del _user_buckets[key]
+            bucket = _user_buckets[user_id] = TokenBucket(CALENDAR_USER_RPS, 1)
+        return bucket
+
+
+def wait_for_quota(user_id=None):
+    """Sleep until both the user's and the process-wide bucket allow an API request."""
+    if user_id is not None:
+        time.sleep(_user_bucket(user_id).reserve())
+    time.sleep(_quota_bucket.reserve())
+
+
+def iter_event_pages(service, calendar_id, params, user_id=None):
+    """Yield (events, next_sync_token) for each page of an events.list call.
+    
+    Pages are requested one at a time as the caller consumes them, so only
+    one page is held in memory. next_sync_token is set on the last page only.
+    Every request waits for quota first.
+    """
+    page_token = None
+    while True:
+        wait_for_quota(user_id)
+        events_result = service.events().list(
+            calendarId=calendar_id,
+            maxResults=CALENDAR_PAGE_SIZE,
+            pageToken=page_token,
+            **params
+        ).execute(num_retries=CALENDAR_API_RETRIES)
+        
+        page_token = events_result.get('nextPageToken')
+        yield events_result.get('items', []), None if page_token else events_result.get('nextSyncToken')
+        if not page_token:
+            return
+
+
+def list_calendar_ids(service, user_id=None):
+    """Return the ids of every calendar in the user's calendar list."""
+    calendar_ids = []
+    page_token = None
+    while True:
+        wait_for_quota(user_id)
+        result = service.calendarList().list(pageToken=page_token).execute(num_retries=CALENDAR_API_RETRIES)
+        calendar_ids += [item['id'] for item in result.get('items', []) if not item.get('deleted')]
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            return calendar_ids
+
+
+def _sync_params(state, now, days):
+    """Return events.list parameters for a sync and the window end of a full one.
+    
+    A stored token is used until the window it came from no longer reaches
+    `days` ahead; then the window is listed again, with a day of slack.
+    """
+    if state.sync_token and state.window_end and state.window_end >= now + timedelta(days=days):
+        # Incremental requests must repeat singleEvents from the full sync
+        return {'syncToken': state.sync_token, 'singleEvents': True}, None
+    
+    window_end = now + timedelta(days=days + 1)
+    return {
+        'timeMin': now.isoformat() + 'Z',  # 'Z' indicates UTC time
+        'timeMax': window_end.isoformat() + 'Z',
+        'singleEvents': True
+    }, window_end
+
+
+def _fetch_calendar(user_id, credentials, calendar_id, params, pages):
+    """Fetch every page of one calendar onto the queue. Runs on a fetch thread."""
+    try:
+        service = _service_for(user_id, credentials)
+        next_sync_token = None
+        for events, next_sync_token in iter_event_pages(service, calendar_id, params, user_id):
+            pages.put((calendar_id, 'page', events), timeout=CALENDAR_QUEUE_TIMEOUT)
+        pages.put((calendar_id, 'done', next_sync_token), timeout=CALENDAR_QUEUE_TIMEOUT)
+    except queue.Full:
+        logger.error(f"Calendar sync for user {user_id} stopped consuming {calendar_id}")
+    except Exception as e:
+        try:
+            pages.put((calendar_id, 'error', e), timeout=CALENDAR_QUEUE_TIMEOUT)
+        except queue.Full:
+            pass
+
+
+def _forget_calendars(user_id, calendar_ids):
+    """Drop stored events and sync state for calendars the user no longer has."""
+    CalendarEvent.query.filter(
+        CalendarEvent.user_id == user_id,
+        CalendarEvent.calendar_id.notin_(calendar_ids)
+    ).delete(synchronize_session=False)
+    CalendarSyncState.query.filter(
+        CalendarSyncState.user_id == user_id,
+        CalendarSyncState.calendar_id.notin_(calendar_ids)
+    ).delete(synchronize_session=False)
+
+
+def sync_calendars(user_id, days=CALENDAR_SYNC_DAYS, calendar_ids=None):
+    """Bring the stored events for a user's calendars up to date.
+    
+    Syncs every calendar in the user's list unless calendar_ids is given.
+    Each calendar is fetched on its own thread, page by page, into a small
+    bounded queue; pages are upserted and committed here as they arrive, so
+    memory stays flat however many events there are.
+    
+    The first sync of a calendar lists the window from now to `days` ahead
+    and stores the nextSyncToken. Later syncs send only the token and get
+    back just the events changed since, with deleted ones marked cancelled,
+    so an unchanged calendar costs one small request. A full resync happens
+    when the window no longer reaches `days` ahead, or when Google expires
+    the token with 410 Gone.
+    """
     service = get_calendar_service(user_id)
     if not service:
         return False
+    credentials = _load_credentials(user_id)
     
     try:
-        # Calculate time min and max
-        now = datetime.utcnow()
-        time_min = now.isoformat() + 'Z'  # 'Z' indicates UTC time
-        time_max = (now + timedelta(days=days)).isoformat() + 'Z'
-        
-        # Call the Calendar API
-        events_result = service.events().list(
-            calendarId='primary',
-            timeMin=time_min,
-            timeMax=time_max,
-            maxResults=50,
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        
-        events = events_result.get('items', [])
+        if calendar_ids is None:
+            calendar_ids = list_calendar_ids(service, user_id)
+            _forget_calendars(user_id, calendar_ids)
+    except HttpError as error:
+        logger.error(f"Error listing calendars for user {user_id}: {error}")
+        return False
+    
+    now = datetime.utcnow()
+    pages = queue.Queue(maxsize=CALENDAR_FETCH_WORKERS * 2)
+    # calendar_id -> [state, window_end, seen ids, (new, changed, deleted)]
+    jobs = {}
+    
+    def start(calendar_id):
+        state = _sync_state(user_id, calendar_id)
+        params, window_end = _sync_params(state, now, days)
+        jobs[calendar_id] = [state, window_end, set(), [0, 0, 0]]
+        _fetch_pool.submit(_fetch_calendar, user_id, credentials, calendar_id, params, pages)
+    
+    for calendar_id in calendar_ids:
+        start(calendar_id)
+    db.session.commit()
+    
+    ok = True
+    while jobs:
+        try:
+            calendar_id, kind, payload = pages.get(timeout=CALENDAR_QUEUE_TIMEOUT)
+        except queue.Empty:
+            logger.error(f"Timed out syncing calendars {sorted(jobs)} for user {user_id}")
+            return False
+        state, window_end, seen, counts = jobs[calendar_id]
         
-        if not events:
-            logger.info(f"No upcoming events found for user {user_id}")
-            return True
+        if kind == 'page':
+            for i, count in enumerate(_apply_events(user_id, calendar_id, payload)):
+                counts[i] += count
+            if window_end:
+                seen.update(event['id'] for event in payload)
+            db.session.commit()
         
-        # Store events in the database
-        for event in events:
-            # Extract event details
-            google_event_id = event['id']
-            title = event.get('summary', 'Unnamed event')
-            description = event.get('description', '')
-            
-            # Parse start and end times
-            start = event.get('start', {})
-            end = event.get('end', {})
-            
-            if 'dateTime' in start:
-                # This is a timed event
-                start_time = datetime.fromisoformat(start['dateTime'].replace('Z', '+00:00'))
-                end_time = datetime.fromisoformat(end['dateTime'].replace('Z', '+00:00'))
-            else:
-                # This is an all-day event
-                start_time = datetime.fromisoformat(start['date'])
-                end_time = datetime.fromisoformat(end['date'])
-            
-            location = event.get('location', '')
+        elif kind == 'done':
+            if window_end:
+                # Anything stored for the window that Google no longer lists
+                # was deleted while we had no token to hear about it
+                stale = CalendarEvent.query.filter(
+                    CalendarEvent.user_id == user_id,
+                    CalendarEvent.calendar_id == calendar_id,
+                    CalendarEvent.start_time >= now
+                )
+                if seen:
+                    stale = stale.filter(CalendarEvent.google_event_id.notin_(seen))
+                stale.delete(synchronize_session=False)
+                state.window_end = window_end
             
-            # Check if event already exists
-            existing_event = CalendarEvent.query.filter_by(
-                google_event_id=google_event_id,
-                user_id=user_id
-            ).first()
+            state.sync_token = payload
+            state.synced_at = datetime.utcnow()
+            db.session.commit()
+            del jobs[calendar_id]
             
-            if existing_event:
-                # Update existing event
-                existing_event.title = title
-                existing_event.description = description
-                existing_event.start_time = start_time
-                existing_event.end_time = end_time
-                existing_event.location = location
-                existing_event.synced_at = datetime.utcnow()
-            else:
-                # Create new event
-                new_event = CalendarEvent(
-                    google_event_id=google_event_id,
-                    title=title,
-                    description=description,
-                    start_time=start_time,
-                    end_time=end_time,
-                    location=location,
-                    user_id=user_id
-                )
-                db.session.add(new_event)
+            mode = "incremental" if window_end is None else "full"
+            logger.info(
+                f"Synced calendar {calendar_id} for user {user_id} ({mode}): "
+                f"{counts[0]} new, {counts[1]} changed, {counts[2]} deleted"
+            )
+        
+        elif isinstance(payload, HttpError) and payload.resp.status == 410 and window_end is None:
+            logger.info(f"Calendar sync token expired for user {user_id}, doing a full resync of {calendar_id}")
+            state.sync_token = None
+            db.session.commit()
+            start(calendar_id)
         
-        db.session.commit()
-        logger.info(f"Successfully synced {len(events)} events for user {user_id}")
-        return True
+        else:
+            logger.error(f"Error syncing calendar {calendar_id} for user {user_id}: {payload}")
+            ok = False
+            del jobs[calendar_id]
     
-    except HttpError as error:
-        logger.error(f"Error syncing calendar events: {error}")
-        return False
+    return ok
+
+
+def sync_calendar(user_id, calendar_id='primary', days=CALENDAR_SYNC_DAYS):
+    """Bring the stored events for one calendar up to date."""
+    return sync_calendars(user_id, days, [calendar_id])
+
+
+def get_upcoming_events(user_id, days=CALENDAR_SYNC_DAYS):
+    """Fetch upcoming events from Google Calendar and store in the database."""
+    return sync_calendars(user_id, days)
@@ -0,0 +1,320 @@
+import os
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import User, CalendarSyncState, SyncWatermark
+from leases import claim_rows
+from calendar_integration import CLIENT_ID, CALENDAR_SYNC_DAYS, sync_calendars
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Calendars of users active within ACTIVE_HOURS are kept at most TTL_MINUTES
+# old; everyone else's at most IDLE_TTL_MINUTES
+CALENDAR_TTL_MINUTES = int(os.environ.get("CALENDAR_TTL_MINUTES", 15))
+CALENDAR_IDLE_TTL_MINUTES = int(os.environ.get("CALENDAR_IDLE_TTL_MINUTES", 360))
+CALENDAR_ACTIVE_HOURS = int(os.environ.get("CALENDAR_ACTIVE_HOURS", 24))
+CALENDAR_REFRESH_INTERVAL_SECONDS = int(os.environ.get("CALENDAR_REFRESH_INTERVAL_SECONDS", 60))
+CALENDAR_REFRESH_BATCH_SIZE = int(os.environ.get("CALENDAR_REFRESH_BATCH_SIZE", 20))
+CALENDAR_RETRY_MAX_SECONDS = 3600
+# Users synced at once; API requests are paced by the quota buckets in
+# calendar_integration whatever this is
+CALENDAR_SYNC_WORKERS = int(os.environ.get("CALENDAR_SYNC_WORKERS", 16))
+# Users looked at per sweep step
+CALENDAR_SWEEP_PAGE_SIZE = int(os.environ.get("CALENDAR_SWEEP_PAGE_SIZE", 500))
+CALENDAR_SWEEP_LEASE_SECONDS = 600
+# Users are leased from before their sync is queued until it finishes
+CALENDAR_SYNC_LEASE_SECONDS = 600
+SWEEP_WATERMARK = "calendar-sweep"
+# Fraction by which a user's TTL may be shortened to spread syncs out
+CALENDAR_TTL_JITTER = 0.2
+# last_seen_at is only written when it is older than this
+LAST_SEEN_RESOLUTION = timedelta(minutes=5)
+
+# Users whose refresh was asked for explicitly, served before stale ones
+_requested = OrderedDict()
+_requested_lock = threading.Lock()
+_wake = threading.Event()
+# user_id -> (failures, monotonic time before which the user is skipped)
+_backoff = {}
+_backoff_lock = threading.Lock()
+_pool = ThreadPoolExecutor(max_workers=CALENDAR_SYNC_WORKERS, thread_name_prefix="calendar-sync")
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def mark_user_active(user):
+    """Record that a user was just seen, so their calendar is kept fresher.
+
+    Written at most every few minutes, and without touching updated_at so
+    activity alone doesn't make the user look changed to replication.
+    Commits.
+    """
+    now = datetime.utcnow()
+    if user.last_seen_at and now - user.last_seen_at < LAST_SEEN_RESOLUTION:
+        return
+    User.query.filter_by(id=user.id).update(
+        {"last_seen_at": now, "updated_at": User.updated_at},
+        synchronize_session=False
+    )
+    db.session.commit()
+
+
+def _synced_at():
+    """Subquery of the oldest calendar sync time per user."""
+    return db.session.query(
+        CalendarSyncState.user_id,
+        func.min(CalendarSyncState.synced_at).label("synced_at")
+    ).group_by(CalendarSyncState.user_id).subquery()
+
+
+def calendar_synced_at(user_id):
+    """Return when the user's least recently synced calendar was synced, or None."""
+    return db.session.query(func.min(CalendarSyncState.synced_at)).filter(
+        CalendarSyncState.user_id == user_id
+    ).scalar()
+
+
+def is_calendar_stale(user_id):
+    synced_at = calendar_synced_at(user_id)
+    return synced_at is None or synced_at < datetime.utcnow() - timedelta(minutes=CALENDAR_TTL_MINUTES)
+
+
+def request_refresh(user_id):
+    """Ask the background refresher to sync a user's calendars soon. Returns immediately."""
+    with _requested_lock:
+        _requested[user_id] = None
+    start_calendar_refresher()
+    _wake.set()
+
+
+def _jitter(user_id):
+    """Return a fixed fraction in [0, 1) for a user.
+
+    TTLs are shortened by up to TTL_JITTER of this, so users that were all
+    synced at once (a new deploy, a sweep) drift apart instead of coming
+    due together every time.
+    """
+    return (user_id * 2654435761 % 2 ** 32) / 2 ** 32
+
+
+def _is_due(user_id, synced_at, last_seen_at, now):
+    if synced_at is None:
+        return True
+    active = last_seen_at is not None and last_seen_at >= now - timedelta(hours=CALENDAR_ACTIVE_HOURS)
+    ttl = CALENDAR_TTL_MINUTES if active else CALENDAR_IDLE_TTL_MINUTES
+    return synced_at < now - timedelta(minutes=ttl * (1 - CALENDAR_TTL_JITTER * _jitter(user_id)))
+
+
+def _backed_off():
+    clock = time.monotonic()
+    with _backoff_lock:
+        return {user_id for user_id, (_, until) in _backoff.items() if until > clock}
+
+
+def stale_users(limit):
+    """Return ids of recently active users whose calendars are past their TTL.
+
+    The longest unsynced come first. Idle and never synced users are left
+    to the sweep.
+    """
+    now = datetime.utcnow()
+    synced = _synced_at()
+    query = db.session.query(User.id, User.last_seen_at, synced.c.synced_at).join(
+        synced, synced.c.user_id == User.id
+    ).filter(
+        User.google_calendar_token.isnot(None),
+        User.last_seen_at >= now - timedelta(hours=CALENDAR_ACTIVE_HOURS),
+        synced.c.synced_at < now - timedelta(minutes=CALENDAR_TTL_MINUTES * (1 - CALENDAR_TTL_JITTER))
+    ).order_by(synced.c.synced_at)
+
+    # Jitter and backoff are applied here rather than in SQL
+    skipped = _backed_off()
+    return [
+        row.id for row in query.limit(limit + len(skipped))
+        if row.id not in skipped and _is_due(row.id, row.synced_at, row.last_seen_at, now)
+    ][:limit]
+
+
+def _known_calendars(user_id):
+    """Return the user's stored calendar ids if they can all sync incrementally, else None.
+
+    This skips the calendarList request on most syncs; the list is fetched
+    again whenever a calendar is due for its daily full resync.
+    """
+    horizon = datetime.utcnow() + timedelta(days=CALENDAR_SYNC_DAYS)
+    states = CalendarSyncState.query.filter_by(user_id=user_id).all()
+    if states and all(state.sync_token and state.window_end and state.window_end >= horizon for state in states):
+        return [state.calendar_id for state in states]
+    return None
+
+
+def _refresh_user(user_id, incremental=True):
+    """Sync one leased user's calendars, backing off on repeated failures. Runs on the sync pool."""
+    from app import app
+
+    with app.app_context():
+        try:
+            ok = sync_calendars(user_id, calendar_ids=_known_calendars(user_id) if incremental else None)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error refreshing calendar for user {user_id}: {e}")
+            ok = False
+        User.query.filter_by(id=user_id).update(
+            {"lease_owner": None, "lease_expires_at": None, "updated_at": User.updated_at},
+            synchronize_session=False
+        )
+        db.session.commit()
+
+    with _backoff_lock:
+        if ok:
+            _backoff.pop(user_id, None)
+        else:
+            failures = _backoff.get(user_id, (0, 0))[0] + 1
+            delay = min(CALENDAR_RETRY_MAX_SECONDS, CALENDAR_REFRESH_INTERVAL_SECONDS * 2 ** failures)
+            _backoff[user_id] = (failures, time.monotonic() + delay)
+    return ok
+
+
+def _refresh_users(user_ids, incremental=True):
+    """Sync users on the pool and wait for all of them. Returns how many succeeded.
+
+    Every process runs a refresher, so users are leased first and any that
+    another process is already syncing are left to it. Must be called
+    inside an app context.
+    """
+    user_ids = list(user_ids)
+    if user_ids:
+        user_ids = claim_rows(
+            User,
+            [User.id.in_(user_ids)],
+            User.id,
+            len(user_ids),
+            lease_seconds=CALENDAR_SYNC_LEASE_SECONDS
+        )
+    futures = [_pool.submit(_refresh_user, user_id, incremental) for user_id in user_ids]
+    return sum(1 for future in futures if future.result())
+
+
+def _sweep_watermark():
+    """Return the sweep's watermark row id, creating the row if needed."""
+    watermark_id = db.session.query(SyncWatermark.id).filter_by(name=SWEEP_WATERMARK).scalar()
+    if watermark_id is not None:
+        return watermark_id
+
+    db.session.add(SyncWatermark(name=SWEEP_WATERMARK, last_id=0))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another process created it first
+        db.session.rollback()
+    return db.session.query(SyncWatermark.id).filter_by(name=SWEEP_WATERMARK).scalar()
+
+
+def sweep_calendars():
+    """Sync the due users in the next page of a sweep over every connected user.
+
+    Users are walked in id order from the watermark's last_id, a page at a
+    time, and the due ones are synced concurrently on the pool. The
+    watermark is committed after every page, so a restart resumes the sweep
+    where it stopped, and leased, so only one process sweeps at a time.
+    Must be called inside an app context. Returns the number of users
+    synced and whether the sweep reached the last user.
+    """
+    ids = claim_rows(
+        SyncWatermark,
+        [SyncWatermark.id == _sweep_watermark()],
+        SyncWatermark.id,
+        1,
+        lease_seconds=CALENDAR_SWEEP_LEASE_SECONDS
+    )
+    if not ids:
+        # Another process is sweeping
+        return 0, True
+
+    watermark = db.session.get(SyncWatermark, ids[0])
+    now = datetime.utcnow()
+    synced = _synced_at()
+    count, finished = 0, True
+    try:
+        rows = db.session.query(User.id, User.last_seen_at, synced.c.synced_at).outerjoin(
+            synced, synced.c.user_id == User.id
+        ).filter(
+            User.google_calendar_token.isnot(None),
+            User.id > watermark.last_id
+        ).order_by(User.id).limit(CALENDAR_SWEEP_PAGE_SIZE).all()
+
+        skipped = _backed_off()
+        count = _refresh_users([
+            row.id for row in rows
+            if row.id not in skipped and _is_due(row.id, row.synced_at, row.last_seen_at, now)
+        ])
+
+        finished = len(rows) < CALENDAR_SWEEP_PAGE_SIZE
+        watermark.last_id = 0 if finished else rows[-1].id
+        if finished:
+            watermark.synced_at = datetime.utcnow()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error sweeping calendars: {e}")
+    finally:
+        watermark.lease_owner = None
+        watermark.lease_expires_at = None
+        db.session.commit()
+
+    return count, finished
+
+
+def refresh_calendars():
+    """Sync requested users, then stale active ones, then the next page of the sweep.
+
+    Must be called inside an app context. Returns the number of users
+    synced and whether work was left over.
+    """
+    with _requested_lock:
+        requested = list(_requested)
+        _requested.clear()
+    count = _refresh_users(requested, incremental=False)
+
+    due = stale_users(CALENDAR_REFRESH_BATCH_SIZE)
+    count += _refresh_users(due)
+
+    swept, finished = sweep_calendars()
+    return count + swept, len(due) == CALENDAR_REFRESH_BATCH_SIZE or not finished
+
+
+def _refresh_forever():
+    from app import app
+
+    while True:
+        _wake.clear()
+        more = False
+        try:
+            with app.app_context():
+                _, more = refresh_calendars()
+        except Exception as e:
+            logger.error(f"Error in calendar refresher: {e}")
+        if not more:
+            _wake.wait(CALENDAR_REFRESH_INTERVAL_SECONDS)
+
+
+def start_calendar_refresher():
+    """Start the background thread that keeps connected calendars fresh."""
+    global _refresher
+
+    if not CLIENT_ID or _refresher is not None:
+        return
+    with _refresher_lock:
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresh_forever, name="calendar-refresher", daemon=True)
+            _refresher.start()
+            logger.info("Calendar refresher started")
@@ -0,0 +1,177 @@
+import os
+import logging
+import time
+from concurrent.futures import Future, TimeoutError
+
+from delivery import submit_message
+from n8n_integration import send_reminder_notification
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+TELEGRAM_TIMEOUT_SECONDS = float(os.environ.get("TELEGRAM_CHANNEL_TIMEOUT_SECONDS", 30))
+
+
+class Notification:
+    """One message to deliver to a user over every channel."""
+
+    __slots__ = ("user_id", "telegram_id", "text", "lane", "skip")
+
+    def __init__(self, user_id, telegram_id, text, lane="default", skip=()):
+        self.user_id = user_id
+        self.telegram_id = telegram_id
+        self.text = text
+        self.lane = lane
+        # Names of channels not to send over, e.g. ones that already did
+        self.skip = frozenset(skip)
+
+
+class ChannelResult:
+    """Outcome of sending one notification over one channel."""
+
+    __slots__ = ("channel", "required", "ok", "error", "elapsed")
+
+    def __init__(self, channel, required, ok, error=None, elapsed=0.0):
+        self.channel = channel
+        self.required = required
+        self.ok = ok
+        self.error = error
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        status = "ok" if self.ok else f"failed: {self.error}"
+        return f"<ChannelResult {self.channel} {status} in {self.elapsed:.2f}s>"
+
+
+class Channel:
+    """A way of reaching a user.
+
+    start() should return quickly with a concurrent.futures.Future that
+    resolves truthy on success; slow work belongs in the future, not the
+    call. fan_out cancels the future on timeout, and a send that hasn't
+    started by then should be dropped. Required channels decide whether a
+    delivery counts as sent; optional ones are best effort.
+    """
+
+    name = None
+    required = False
+    timeout = 10.0
+
+    def start(self, notification):
+        raise NotImplementedError
+
+
+class TelegramChannel(Channel):
+    """Telegram through the bot's rate-limited delivery queue."""
+
+    name = "telegram"
+    required = True
+    timeout = TELEGRAM_TIMEOUT_SECONDS
+
+    def start(self, notification):
+        # Waiting for room in a full queue counts against the channel timeout
+        future = submit_message(
+            int(notification.telegram_id), notification.text, notification.lane, self.timeout
+        )
+        if future is None:
+            raise RuntimeError("Bot delivery queue not running in this process")
+        return future
+
+
+class N8nChannel(Channel):
+    """The n8n send_notification webhook, kept for redundancy.
+
+    The event only goes onto n8n_integration's shipper queue here, which
+    doesn't block, so it is queued inline and "ok" means queued; the
+    shipper posts it and retries on its own.
+    """
+
+    name = "n8n"
+    required = False
+
+    def start(self, notification):
+        future = Future()
+        future.set_result(send_reminder_notification(
+            notification.user_id,
+            notification.telegram_id,
+            notification.text
+        ))
+        return future
+
+
+CHANNELS = [TelegramChannel(), N8nChannel()]
+
+
+def register_channel(channel):
+    """Add a channel to every fan-out."""
+    CHANNELS.append(channel)
+
+
+def _failed(error):
+    future = Future()
+    future.set_exception(error)
+    return future
+
+
+def fan_out(notifications, channels=None):
+    """Send notifications over all channels concurrently.
+
+    Every (notification, channel) send is started before any is waited on,
+    and each is given its own channel's timeout measured from the start, so
+    the whole call takes about as long as the slowest healthy channel.
+    Channels in a notification's skip set are left out. Returns one list of
+    ChannelResult per notification, in order.
+    """
+    channels = CHANNELS if channels is None else channels
+    started = time.monotonic()
+
+    pending = []
+    for notification in notifications:
+        row = []
+        for channel in channels:
+            if channel.name in notification.skip:
+                continue
+            try:
+                future = channel.start(notification)
+            except Exception as e:
+                future = _failed(e)
+            # [channel, future, finished_at]; the callback records completion
+            # time so elapsed doesn't depend on the order we wait in
+            entry = [channel, future, None]
+            future.add_done_callback(lambda f, entry=entry: entry.__setitem__(2, time.monotonic()))
+            row.append(entry)
+        pending.append(row)
+
+    results = []
+    for notification, row in zip(notifications, pending):
+        outcomes = []
+        for channel, future, _ in row:
+            remaining = max(0.0, started + channel.timeout - time.monotonic())
+            try:
+                ok = bool(future.result(timeout=remaining))
+                error = None if ok else "Channel reported failure"
+            except TimeoutError:
+                # Channels drop work that hasn't started yet when cancelled
+                future.cancel()
+                ok, error = False, f"Timed out after {channel.timeout}s"
+            except Exception as e:
+                ok, error = False, str(e) or type(e).__name__
+            outcomes.append(ChannelResult(channel.name, channel.required, ok, error))
+            if not ok:
+                logger.warning(f"Channel {channel.name} failed for user {notification.user_id}: {error}")
+        for result, (_, _, finished_at) in zip(outcomes, row):
+            result.elapsed = (finished_at or time.monotonic()) - started
+        results.append(outcomes)
+
+    return results
+
+
+def optional_channels():
+    """Names of the channels that are only best effort."""
+    return {channel.name for channel in CHANNELS if not channel.required}
+
+
+def delivered(results):
+    """Return True if every required channel in a fan-out result succeeded."""
+    return all(result.ok for result in results if result.required)
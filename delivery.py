@@ -0,0 +1,319 @@
+import os
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, TimeoutError
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+
+from utils import TokenBucket
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall and 1 per second per chat
+GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+DELIVERY_CONCURRENCY = int(os.environ.get("TELEGRAM_DELIVERY_CONCURRENCY", 30))
+DELIVERY_QUEUE_SIZE = int(os.environ.get("TELEGRAM_DELIVERY_QUEUE_SIZE", 1000))
+MAX_RETRY_AFTER_ATTEMPTS = 3
+
+# Relative share of sends each lane gets while several lanes are backlogged.
+# Lanes are keyed on Reminder.type; anything else goes to "default".
+LANE_WEIGHTS = {
+    "medication": 8,
+    "task": 4,
+    "calendar": 4,
+    "default": 2,
+    "water": 1,
+}
+LATENCY_SAMPLES = 1000
+
+# Queue running on the bot's event loop, set once the bot has started
+delivery_queue = None
+
+
+class _Message:
+    """A message waiting in the delivery queue."""
+
+    __slots__ = ("chat_id", "text", "future", "enqueued_at")
+
+    def __init__(self, chat_id, text, future, enqueued_at):
+        self.chat_id = chat_id
+        self.text = text
+        self.future = future
+        self.enqueued_at = enqueued_at
+
+
+class _Lane:
+    """FIFO of messages of one priority class plus its latency stats."""
+
+    __slots__ = ("name", "weight", "messages", "current", "sent", "failed", "latencies")
+
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.messages = deque()
+        # Smooth weighted round-robin credit
+        self.current = 0
+        self.sent = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3)
+
+        return {
+            "weight": self.weight,
+            "queued": len(self.messages),
+            "sent": self.sent,
+            "failed": self.failed,
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+            "latency_max": round(latencies[-1], 3) if latencies else None,
+        }
+
+
+def lane_for(types):
+    """Return the highest-priority lane among the given reminder types."""
+    lanes = [t if t in LANE_WEIGHTS else "default" for t in types] or ["default"]
+    return max(lanes, key=lambda lane: LANE_WEIGHTS[lane])
+
+
+class DeliveryQueue:
+    """Rate-limited Telegram sender that runs on the bot's event loop.
+
+    Messages wait in per-type priority lanes that share one capacity limit,
+    and a fixed number of worker tasks drain them with smooth weighted
+    round-robin. A backlog of water pings can't starve medication reminders,
+    and idle lanes don't waste their share. Each send waits on a per-chat
+    bucket and then the global bucket, so bursts drain at Telegram's limits
+    instead of triggering 429s. If Telegram still answers with RetryAfter,
+    all workers pause for the requested time before the message is retried.
+    """
+
+    def __init__(self, bot, loop, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE,
+                 concurrency=DELIVERY_CONCURRENCY, maxsize=DELIVERY_QUEUE_SIZE):
+        self.bot = bot
+        self.loop = loop
+        self.chat_rate = chat_rate
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self._global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = {}
+        self._lanes = {name: _Lane(name, weight) for name, weight in LANE_WEIGHTS.items()}
+        self._size = 0
+        self._lock = asyncio.Lock()
+        self._not_empty = asyncio.Condition(self._lock)
+        self._not_full = asyncio.Condition(self._lock)
+        self._paused_until = 0.0
+        self._workers = []
+
+    def start(self):
+        """Start the worker tasks. Must be called on the queue's event loop."""
+        for i in range(self.concurrency):
+            self._workers.append(self.loop.create_task(self._worker(), name=f"telegram-delivery-{i}"))
+        logger.info(f"Delivery queue started with {self.concurrency} workers")
+
+    async def put(self, chat_id, text, lane="default"):
+        """Enqueue a message, waiting while the queue is full, and return a future for the send."""
+        lane = self._lanes.get(lane) or self._lanes["default"]
+        future = self.loop.create_future()
+        async with self._not_full:
+            while self._size >= self.maxsize:
+                await self._not_full.wait()
+            lane.messages.append(_Message(chat_id, text, future, self.loop.time()))
+            self._size += 1
+            self._not_empty.notify()
+        return future
+
+    async def send(self, chat_id, text, lane="default"):
+        """Enqueue a message and wait until it has been sent."""
+        return await (await self.put(chat_id, text, lane))
+
+    def submit(self, chat_id, text, lane="default", timeout=None):
+        """Queue a message from another thread.
+
+        Blocks the caller while the queue is full, which is what pushes back
+        on the dispatcher during a burst, for at most `timeout` seconds.
+        Returns a concurrent.futures.Future that resolves to True once the
+        message is sent or raises the send error. If the message couldn't
+        be queued in time the future raises TimeoutError, and the message
+        is dropped even if it gets queued later.
+        """
+        accepted = asyncio.run_coroutine_threadsafe(self.put(chat_id, text, lane), self.loop)
+        result = Future()
+
+        def _copy(future):
+            # result may have been cancelled by the submitter meanwhile
+            if result.done():
+                return
+            try:
+                if future.cancelled():
+                    result.cancel()
+                elif future.exception() is not None:
+                    result.set_exception(future.exception())
+                else:
+                    result.set_result(future.result())
+            except InvalidStateError:
+                pass
+
+        def _link(sent):
+            # Runs on the loop once the message is in a lane. Cancelling
+            # result, e.g. on a channel timeout, cancels the queued message
+            # so the workers skip it.
+            if result.cancelled():
+                sent.cancel()
+                return
+            sent.add_done_callback(_copy)
+            result.add_done_callback(lambda r: r.cancelled() and self._cancel_soon(sent))
+
+        def _accepted(future):
+            if not future.cancelled() and future.exception() is None:
+                self.loop.call_soon_threadsafe(_link, future.result())
+
+        accepted.add_done_callback(_accepted)
+        try:
+            accepted.result(timeout)
+        except TimeoutError:
+            accepted.cancel()
+            result.cancel()
+            failed = Future()
+            failed.set_exception(TimeoutError(f"Delivery queue did not take the message within {timeout}s"))
+            return failed
+        return result
+
+    def _cancel_soon(self, future):
+        """Cancel a loop future from any thread."""
+        try:
+            self.loop.call_soon_threadsafe(future.cancel)
+        except RuntimeError:
+            # The loop is closed and nothing will send it anyway
+            pass
+
+    def qsize(self):
+        return self._size
+
+    def metrics(self):
+        """Per-lane queue depth, outcome counts and enqueue-to-send latency in seconds."""
+        return {name: lane.metrics() for name, lane in self._lanes.items()}
+
+    def _pick_lane(self):
+        """Choose the next lane by smooth weighted round-robin over non-empty lanes."""
+        best = None
+        total = 0
+        for lane in self._lanes.values():
+            if not lane.messages:
+                continue
+            lane.current += lane.weight
+            total += lane.weight
+            if best is None or lane.current > best.current:
+                best = lane
+        best.current -= total
+        return best
+
+    async def _get(self):
+        async with self._not_empty:
+            while self._size == 0:
+                await self._not_empty.wait()
+            lane = self._pick_lane()
+            message = lane.messages.popleft()
+            self._size -= 1
+            self._not_full.notify()
+        return lane, message
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Drop buckets for chats that have gone quiet so the map stays small
+            if len(self._chat_buckets) > 10000:
+                self._chat_buckets = {
+                    key: value for key, value in self._chat_buckets.items() if not value.idle()
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    async def _wait_for_slot(self, chat_id):
+        """Sleep until both the chat and the global bucket allow a send."""
+        await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+        pause = self._paused_until - self.loop.time()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        await asyncio.sleep(self._global_bucket.reserve())
+
+    async def _deliver(self, message):
+        for attempt in range(1, MAX_RETRY_AFTER_ATTEMPTS + 1):
+            await self._wait_for_slot(message.chat_id)
+            try:
+                await self.bot.send_message(chat_id=message.chat_id, text=message.text)
+                return True
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"Telegram rate limit hit, pausing deliveries for {retry_after}s")
+                self._paused_until = max(self._paused_until, self.loop.time() + retry_after)
+                if attempt == MAX_RETRY_AFTER_ATTEMPTS:
+                    raise
+
+    async def _worker(self):
+        while True:
+            lane, message = await self._get()
+            if message.future.cancelled():
+                # Abandoned by the submitter while it waited
+                continue
+            try:
+                result = await self._deliver(message)
+                lane.sent += 1
+                if not message.future.done():
+                    message.future.set_result(result)
+            except asyncio.CancelledError:
+                if not message.future.done():
+                    message.future.cancel()
+                raise
+            except Exception as e:
+                lane.failed += 1
+                logger.error(f"Error delivering message to {message.chat_id}: {e}")
+                if not message.future.done():
+                    message.future.set_exception(e)
+            finally:
+                lane.latencies.append(self.loop.time() - message.enqueued_at)
+
+
+def start_delivery_queue(bot):
+    """Create and start the delivery queue on the running event loop."""
+    global delivery_queue
+
+    delivery_queue = DeliveryQueue(bot, asyncio.get_running_loop())
+    delivery_queue.start()
+    return delivery_queue
+
+
+def submit_message(chat_id, text, lane="default", timeout=None):
+    """Queue a Telegram message from any thread on the given priority lane.
+
+    Returns a concurrent.futures.Future for the send, or None if the bot
+    isn't running in this process. See DeliveryQueue.submit for timeout.
+    """
+    if delivery_queue is None:
+        return None
+    return delivery_queue.submit(chat_id, text, lane, timeout)
+
+
+def delivery_running():
+    """Return True if the bot's delivery queue is running in this process."""
+    return delivery_queue is not None
+
+
+def delivery_metrics():
+    """Per-lane delivery metrics, or None if the bot isn't running in this process."""
+    if delivery_queue is None:
+        return None
+    return delivery_queue.metrics()
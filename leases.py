@@ -0,0 +1,54 @@
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+
+from app import db
+
+# Identifies this process in lease_owner columns
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEASE_SECONDS = int(os.environ.get("REMINDER_LEASE_SECONDS", 60))
+
+
+def claim_rows(model, criteria, order_by, limit, lease_seconds=LEASE_SECONDS):
+    """Atomically lease up to `limit` rows of a model with lease columns.
+    
+    order_by is one expression or a tuple of them. On Postgres the candidate
+    rows are locked with FOR UPDATE SKIP LOCKED so concurrent workers take
+    disjoint batches. SQLite has no row locks, so the lease is taken with a
+    conditional UPDATE, which SQLite serializes. Returns the claimed ids.
+    """
+    now = datetime.utcnow()
+    lease_owner = f"{WORKER_ID}:{uuid.uuid4().hex[:8]}"
+    lease_expires_at = now + timedelta(seconds=lease_seconds)
+    lease_free = or_(model.lease_expires_at.is_(None), model.lease_expires_at < now)
+    lease = {"lease_owner": lease_owner, "lease_expires_at": lease_expires_at}
+    if "updated_at" in model.__table__.c:
+        # Keep updated_at as it is, or taking a lease would make the row look
+        # changed to replication
+        lease["updated_at"] = model.updated_at
+    
+    if not isinstance(order_by, tuple):
+        order_by = (order_by,)
+    
+    candidates = db.session.query(model.id).filter(*criteria, lease_free).order_by(*order_by).limit(limit)
+    
+    if db.engine.dialect.name == "postgresql":
+        ids = [row.id for row in candidates.with_for_update(skip_locked=True)]
+        if not ids:
+            db.session.rollback()
+            return []
+        model.query.filter(model.id.in_(ids)).update(lease, synchronize_session=False)
+        db.session.commit()
+        return ids
+    
+    # The lease condition is repeated in the outer UPDATE so a row leased by
+    # another process between the subquery and the write is not stolen.
+    model.query.filter(model.id.in_(candidates.scalar_subquery()), lease_free).update(
+        lease, synchronize_session=False
+    )
+    db.session.commit()
+    
+    return [row.id for row in db.session.query(model.id).filter_by(lease_owner=lease_owner)]
@@ -0,0 +1,163 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import inspect, literal
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+
+from app import db
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# What DDL raises when another process starting at the same time applied
+# the same change first
+DDL_RACE_ERRORS = (IntegrityError, OperationalError, ProgrammingError)
+
+
+def _column_ddl(column, dialect):
+    """Column definition for ALTER TABLE ... ADD COLUMN."""
+    ddl = f"{dialect.identifier_preparer.quote(column.name)} {column.type.compile(dialect=dialect)}"
+    default = column.default
+    if default is not None and default.is_scalar:
+        value = literal(default.arg, column.type).compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+        ddl += f" DEFAULT {value}"
+    if not column.nullable:
+        # Only possible for existing rows with a default to fill them
+        ddl += " NOT NULL"
+    return ddl
+
+
+def _add_missing_columns():
+    """Add model columns that existing tables lack. Returns their names."""
+    added = []
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            dialect = db.engine.dialect
+            statement = (
+                f"ALTER TABLE {dialect.identifier_preparer.quote(table.name)} "
+                f"ADD COLUMN {_column_ddl(column, dialect)}"
+            )
+            try:
+                with db.engine.begin() as conn:
+                    conn.exec_driver_sql(statement)
+            except DDL_RACE_ERRORS:
+                # Another process starting at the same time may have added it
+                columns = {c["name"] for c in inspect(db.engine).get_columns(table.name)}
+                if column.name not in columns:
+                    raise
+                continue
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def _replace_calendar_event_unique():
+    """Swap the old global UNIQUE(google_event_id) for the per-user, per-calendar one.
+
+    SQLite can't drop a constraint, so there the table is rebuilt from the
+    model and the rows copied across. Returns True if anything changed.
+    """
+    table = db.metadata.tables["calendar_event"]
+    old = _old_calendar_event_unique()
+    if not old:
+        return False
+
+    try:
+        _swap_calendar_event_unique(table, old)
+    except DDL_RACE_ERRORS:
+        # Another process starting at the same time may have swapped it
+        if _old_calendar_event_unique():
+            raise
+        return False
+    return True
+
+
+def _old_calendar_event_unique():
+    """Return the old UNIQUE(google_event_id) constraints still on calendar_event."""
+    inspector = inspect(db.engine)
+    if not inspector.has_table("calendar_event"):
+        return []
+    return [
+        constraint for constraint in inspector.get_unique_constraints("calendar_event")
+        if constraint["column_names"] == ["google_event_id"]
+    ]
+
+
+def _swap_calendar_event_unique(table, old):
+    """Drop the old constraints and add the new one, in one transaction where the database allows."""
+    with db.engine.begin() as conn:
+        if conn.dialect.name == "sqlite":
+            columns = ", ".join(conn.dialect.identifier_preparer.quote(c.name) for c in table.columns)
+            conn.exec_driver_sql("ALTER TABLE calendar_event RENAME TO calendar_event_old")
+            table.create(conn)
+            conn.exec_driver_sql(
+                f"INSERT INTO calendar_event ({columns}) SELECT {columns} FROM calendar_event_old"
+            )
+            conn.exec_driver_sql("DROP TABLE calendar_event_old")
+        else:
+            for constraint in old:
+                conn.exec_driver_sql(
+                    f"ALTER TABLE calendar_event DROP CONSTRAINT "
+                    f"{conn.dialect.identifier_preparer.quote(constraint['name'])}"
+                )
+            conn.exec_driver_sql(
+                "ALTER TABLE calendar_event ADD CONSTRAINT uq_calendar_event_user_event "
+                "UNIQUE (user_id, calendar_id, google_event_id)"
+            )
+
+
+def _create_missing_indexes():
+    """Create model indexes that existing tables lack."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except DDL_RACE_ERRORS:
+                # Another process starting at the same time may have created it
+                indexes = {i["name"] for i in inspect(db.engine).get_indexes(table.name)}
+                if index.name not in indexes:
+                    raise
+
+
+def _backfill_updated_at():
+    """Stamp rows from before updated_at existed with their created_at."""
+    now = datetime.utcnow()
+    filled = 0
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if "updated_at" not in table.c or "created_at" not in table.c:
+                continue
+            filled += conn.execute(
+                table.update().where(table.c.updated_at.is_(None)).values(
+                    updated_at=db.func.coalesce(table.c.created_at, now)
+                )
+            ).rowcount
+    return filled
+
+
+def upgrade_schema():
+    """Bring tables created by an older version up to the current models.
+
+    db.create_all() only creates missing tables, so columns, indexes and
+    constraints added to existing ones are applied here. Every step checks
+    the live schema first, and tolerates another worker booting at the same
+    time applying it first, so running this on every startup is safe.
+    Must be called inside an app context, after db.create_all().
+    """
+    added = _add_missing_columns()
+    rebuilt = _replace_calendar_event_unique()
+    _create_missing_indexes()
+    filled = _backfill_updated_at()
+
+    if added or rebuilt or filled:
+        logger.info(
+            f"Upgraded schema: added columns {added}, "
+            f"{'replaced' if rebuilt else 'kept'} calendar_event unique constraint, "
+            f"backfilled updated_at on {filled} rows"
+        )
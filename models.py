@@ -11,6 +11,11 @@ class User(UserMixin, db.Model):
     telegram_id = db.Column(db.String(20), unique=True)
     google_calendar_token = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    last_seen_at = db.Column(db.DateTime)  # last bot or web activity, to prioritize calendar refreshes
+    # Held by the process syncing the user's calendars so others skip them
+    lease_owner = db.Column(db.String(64))
+    lease_expires_at = db.Column(db.DateTime)
     tasks = db.relationship('Task', backref='user', lazy=True)
     reminders = db.relationship('Reminder', backref='user', lazy=True)
 
@@ -24,9 +29,15 @@ class Task(db.Model):
     completed = db.Column(db.Boolean, default=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
 
 class Reminder(db.Model):
+    __table_args__ = (
+        # Serves the startup load and the dispatcher's due-row claims
+        db.Index('ix_reminder_active_scheduled_time', 'active', 'scheduled_time'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String(20), nullable=False)  # water, medication, task, calendar
     message = db.Column(db.Text, nullable=False)
@@ -36,12 +47,51 @@ class Reminder(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     task_id = db.Column(db.Integer, db.ForeignKey('task.id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     last_sent_at = db.Column(db.DateTime)
+    # Set while a process is delivering the reminder so others skip it
+    lease_owner = db.Column(db.String(64))
+    lease_expires_at = db.Column(db.DateTime)
+
+
+# Outbox row for one firing of a reminder, retried until delivered
+class ReminderDelivery(db.Model):
+    __table_args__ = (
+        # Serves outbox claims, highest priority first
+        db.Index('ix_reminder_delivery_status_priority_next_attempt', 'status', 'priority', 'next_attempt_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    # "<reminder_id>:<fire_time>" so a firing is only recorded once
+    idempotency_key = db.Column(db.String(64), unique=True, nullable=False)
+    reminder_id = db.Column(db.Integer, db.ForeignKey('reminder.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    reminder_type = db.Column(db.String(20))  # copied from Reminder.type to pick a delivery lane
+    priority = db.Column(db.Integer, default=0, nullable=False)  # the lane's weight, higher is claimed first
+    message = db.Column(db.Text, nullable=False)
+    fire_time = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, sent, failed
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    last_error = db.Column(db.Text)
+    # Comma-separated channels that already delivered it, skipped on retries
+    channels_sent = db.Column(db.String(200))
+    lease_owner = db.Column(db.String(64))
+    lease_expires_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
 
 
 class CalendarEvent(db.Model):
+    __table_args__ = (
+        # Event ids are only unique within a calendar, and a shared event
+        # shows up for every user who can see it
+        db.UniqueConstraint('user_id', 'calendar_id', 'google_event_id', name='uq_calendar_event_user_event'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
-    google_event_id = db.Column(db.String(100), unique=True)
+    google_event_id = db.Column(db.String(100))
+    calendar_id = db.Column(db.String(200), default='primary', nullable=False)
     title = db.Column(db.String(120), nullable=False)
     description = db.Column(db.Text)
     start_time = db.Column(db.DateTime, nullable=False)
@@ -49,3 +99,46 @@ class CalendarEvent(db.Model):
     location = db.Column(db.String(200))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     synced_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# Google Calendar incremental sync position for one user's calendar
+class CalendarSyncState(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'calendar_id', name='uq_calendar_sync_state_user_calendar'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    calendar_id = db.Column(db.String(200), default='primary', nullable=False)
+    sync_token = db.Column(db.Text)  # nextSyncToken from the last completed sync
+    window_end = db.Column(db.DateTime)  # timeMax of the full sync the token came from
+    synced_at = db.Column(db.DateTime)
+
+
+# Webhook event waiting to be shipped to n8n, deleted once posted
+class N8nEvent(db.Model):
+    __table_args__ = (
+        db.Index('ix_n8n_event_next_attempt_at', 'next_attempt_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    event_type = db.Column(db.String(50), nullable=False)
+    body = db.Column(db.Text, nullable=False)  # JSON as posted: event_type, timestamp, data
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    last_error = db.Column(db.Text)
+    lease_owner = db.Column(db.String(64))
+    lease_expires_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# How far a replication job has got, as the (updated_at, id) of the last row copied
+class SyncWatermark(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)
+    updated_at = db.Column(db.DateTime)
+    last_id = db.Column(db.Integer, default=0, nullable=False)
+    synced_at = db.Column(db.DateTime)
+    # Held by the process running the job so runs don't overlap
+    lease_owner = db.Column(db.String(64))
+    lease_expires_at = db.Column(db.DateTime)
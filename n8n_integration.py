@@ -1,8 +1,16 @@
 import os
 import logging
 import json
+import queue
+import random
+import threading
+import time
 import requests
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+
+from utils import CircuitBreaker
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -11,38 +19,433 @@ logger = logging.getLogger(__name__)
 # Get n8n webhook URL from environment
 N8N_WEBHOOK_URL = os.environ.get("N8N_WEBHOOK_URL")
 
+# Connection pool and timeouts for webhook calls
+N8N_CONNECT_TIMEOUT = float(os.environ.get("N8N_CONNECT_TIMEOUT", 3.05))
+N8N_READ_TIMEOUT = float(os.environ.get("N8N_READ_TIMEOUT", 10))
+N8N_POOL_SIZE = int(os.environ.get("N8N_POOL_SIZE", 10))
+
+# Events are queued in memory, written to the n8n_event table and posted in
+# batches by a background shipper; N8N_BATCH_SIZE=1 keeps one event per POST
+N8N_BATCH_SIZE = int(os.environ.get("N8N_BATCH_SIZE", 50))
+N8N_FLUSH_SECONDS = float(os.environ.get("N8N_FLUSH_SECONDS", 2))
+N8N_QUEUE_SIZE = int(os.environ.get("N8N_QUEUE_SIZE", 10000))
+N8N_RETRY_POLL_SECONDS = 15
+N8N_MAX_ATTEMPTS = int(os.environ.get("N8N_MAX_ATTEMPTS", 10))
+N8N_BASE_BACKOFF_SECONDS = 5
+N8N_MAX_BACKOFF_SECONDS = 600
+
+# Circuit breaker: stop calling n8n after this many consecutive failures and
+# probe again after the reset timeout
+N8N_BREAKER_FAILURES = int(os.environ.get("N8N_BREAKER_FAILURES", 5))
+N8N_BREAKER_RESET_SECONDS = float(os.environ.get("N8N_BREAKER_RESET_SECONDS", 30))
+
+
+def _parse_policies(spec):
+    """Parse "event_type=drop,other=defer" into a dict."""
+    policies = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        event_type, _, policy = item.partition("=")
+        if policy not in ("drop", "defer"):
+            logger.error(f"Ignoring unknown n8n event policy '{item}'")
+            continue
+        policies[event_type.strip()] = policy
+    return policies
+
+
+# What happens to events while the breaker is open: "drop" sheds them, "defer"
+# keeps them queued until n8n recovers. Reminder copies and calendar sync
+# triggers are stale by then anyway; everything else defers by default.
+N8N_EVENT_POLICIES = {
+    "send_notification": "drop",
+    "calendar_action": "drop",
+    **_parse_policies(os.environ.get("N8N_EVENT_POLICIES", ""))
+}
+
+# Shared clients, created on first use
+_session = None
+_session_lock = threading.Lock()
+_async_client = None
+
+# Background shipper state
+_events = queue.Queue(maxsize=N8N_QUEUE_SIZE)
+_shipper = None
+_shipper_lock = threading.Lock()
+
+_breaker = CircuitBreaker(N8N_BREAKER_FAILURES, N8N_BREAKER_RESET_SECONDS)
+_shed = Counter()
+_shed_lock = threading.Lock()
+
+
+def get_session():
+    """Get or create the pooled keep-alive session used for webhook calls."""
+    global _session
+    
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=N8N_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({"Content-Type": "application/json"})
+                _session = session
+    
+    return _session
+
+
+def get_async_client():
+    """Get or create the async client for webhook calls from the bot's event loop.
+    
+    httpx clients are tied to the event loop they were first used on, so this
+    must only be called from that loop.
+    """
+    global _async_client
+    
+    if _async_client is None:
+        import httpx
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(N8N_READ_TIMEOUT, connect=N8N_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=N8N_POOL_SIZE, max_keepalive_connections=N8N_POOL_SIZE),
+            headers={"Content-Type": "application/json"}
+        )
+    
+    return _async_client
+
+
+def _workflow_payload(event_type, payload):
+    """Wrap a payload with its event type and timestamp."""
+    return {
+        "event_type": event_type,
+        "timestamp": datetime.utcnow().isoformat(),
+        "data": payload
+    }
+
+
+def _batch_payload(events):
+    """Wrap several workflow payloads in one envelope.
+    
+    A single event is posted as-is so workflows that only understand one
+    event per call keep working when traffic is low.
+    """
+    if len(events) == 1:
+        return events[0]
+    return {
+        "event_type": "batch",
+        "timestamp": datetime.utcnow().isoformat(),
+        "events": events
+    }
+
+
+def _record_response(status_code):
+    """Feed a webhook response into the breaker; only server errors count as failures."""
+    if status_code >= 500:
+        _breaker.record_failure()
+    else:
+        _breaker.record_success()
+
+
+def _rejected(status_code):
+    """Return True if n8n refused the request itself, so sending it again won't help."""
+    return status_code is not None and 400 <= status_code < 500 and status_code not in (408, 429)
+
+
+def _send(body):
+    """POST to the webhook over the shared session and record the outcome on the breaker.
+    
+    Returns the response status code, or None if no response came back.
+    """
+    try:
+        # Send webhook request over the shared keep-alive session
+        response = get_session().post(
+            N8N_WEBHOOK_URL,
+            json=body,
+            timeout=(N8N_CONNECT_TIMEOUT, N8N_READ_TIMEOUT)
+        )
+    except Exception as e:
+        _breaker.record_failure()
+        logger.error(f"Error triggering n8n workflow: {e}")
+        return None
+    
+    _record_response(response.status_code)
+    if response.status_code == 200:
+        logger.info(f"Successfully triggered n8n workflow for {body['event_type']}")
+    else:
+        logger.error(f"Error triggering n8n workflow: {response.status_code} - {response.text}")
+    return response.status_code
+
+
+def post_workflow(body):
+    """POST a workflow payload or batch envelope to the n8n webhook and wait for the answer.
+    
+    Returns False straight away while the circuit breaker is open.
+    """
+    if not N8N_WEBHOOK_URL:
+        logger.warning("N8N_WEBHOOK_URL not set, skipping workflow trigger")
+        return False
+    
+    if not _breaker.allow():
+        logger.debug(f"n8n circuit open, not posting {body['event_type']}")
+        return False
+    
+    return _send(body) == 200
+
+
+def _count_shed(event_type, count=1):
+    with _shed_lock:
+        _shed[event_type] += count
+
+
+def _should_shed(event_type):
+    """Return True if an event of this type should be dropped right now."""
+    return (N8N_EVENT_POLICIES.get(event_type, "defer") == "drop"
+            and _breaker.state == CircuitBreaker.OPEN)
+
 
 def trigger_workflow(event_type, payload):
-    """Trigger an n8n workflow using webhook."""
+    """Queue an n8n workflow trigger for the background shipper.
+    
+    Returns as soon as the event is queued; delivery is retried from the
+    database until n8n accepts it. While the circuit breaker is open, event
+    types with the "drop" policy are discarded and False is returned.
+    """
     if not N8N_WEBHOOK_URL:
         logger.warning("N8N_WEBHOOK_URL not set, skipping workflow trigger")
         return False
     
+    if _should_shed(event_type):
+        _count_shed(event_type)
+        return False
+    
+    start_event_shipper()
+    event = _workflow_payload(event_type, payload)
     try:
-        # Add event type and timestamp to payload
-        full_payload = {
-            "event_type": event_type,
-            "timestamp": datetime.utcnow().isoformat(),
-            "data": payload
-        }
-        
-        # Send webhook request
-        response = requests.post(
-            N8N_WEBHOOK_URL,
-            json=full_payload,
-            headers={"Content-Type": "application/json"}
-        )
+        _events.put_nowait(event)
+    except queue.Full:
+        # The shipper is behind; persist on the caller's thread rather than drop
+        logger.warning(f"n8n event queue full, writing {event_type} straight to the database")
+        _persist_events([event])
+    return True
+
+
+def start_event_shipper():
+    """Start the background thread that ships queued and persisted events."""
+    global _shipper
+    
+    if not N8N_WEBHOOK_URL or _shipper is not None:
+        return
+    with _shipper_lock:
+        if _shipper is None:
+            _shipper = threading.Thread(target=_ship_forever, name="n8n-shipper", daemon=True)
+            _shipper.start()
+            logger.info("n8n event shipper started")
+
+
+def _collect_batch():
+    """Wait for queued events and return up to N8N_BATCH_SIZE of them.
+    
+    The batch is cut when it is full or N8N_FLUSH_SECONDS after its first
+    event, whichever comes first. Returns [] if nothing arrived.
+    """
+    try:
+        batch = [_events.get(timeout=N8N_FLUSH_SECONDS)]
+    except queue.Empty:
+        return []
+    
+    deadline = time.monotonic() + N8N_FLUSH_SECONDS
+    while len(batch) < N8N_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_events.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _persist_events(events):
+    """Write events to the n8n_event table so they survive a restart."""
+    from app import app, db
+    from models import N8nEvent
+    
+    with app.app_context():
+        db.session.add_all([
+            N8nEvent(event_type=event["event_type"], body=json.dumps(event))
+            for event in events
+        ])
+        db.session.commit()
+
+
+def _retry_delay(attempts):
+    """Exponential backoff with jitter for the given attempt count."""
+    delay = min(N8N_MAX_BACKOFF_SECONDS, N8N_BASE_BACKOFF_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _ship_pending():
+    """Post due events from the n8n_event table in batches until none are left.
+    
+    Rows are leased so several processes can ship at once. Shipped rows are
+    deleted; failed ones are retried with backoff and dropped after
+    N8N_MAX_ATTEMPTS. If n8n rejects a batch with a 4xx, its events are
+    sent one by one and only the rejected ones are dropped. While the
+    circuit breaker is open nothing is posted, rows are left for later
+    without counting an attempt, and event types with the "drop" policy
+    are deleted.
+    """
+    from app import app, db
+    from models import N8nEvent
+    from leases import claim_rows
+    
+    shipped = 0
+    while True:
+        with app.app_context():
+            ids = claim_rows(
+                N8nEvent,
+                [N8nEvent.next_attempt_at <= datetime.utcnow()],
+                N8nEvent.id,
+                N8N_BATCH_SIZE
+            )
+            if not ids:
+                break
+            
+            # Ask the breaker only once there is something to send, so a
+            # half-open probe isn't used up by an empty scan
+            if not _breaker.allow():
+                N8nEvent.query.filter(N8nEvent.id.in_(ids)).update(
+                    {"lease_owner": None, "lease_expires_at": None},
+                    synchronize_session=False
+                )
+                if _breaker.state == CircuitBreaker.OPEN:
+                    _shed_persisted()
+                db.session.commit()
+                break
+            
+            rows = N8nEvent.query.filter(N8nEvent.id.in_(ids)).order_by(N8nEvent.id).all()
+            status = _send(_batch_payload([json.loads(row.body) for row in rows]))
+            if _rejected(status) and len(rows) > 1:
+                # One bad event fails the whole envelope; find it by sending
+                # the events one at a time so the rest still go out
+                outcomes = []
+                answering = True
+                for row in rows:
+                    # If n8n stops answering, the rest are retried later
+                    row_status = _send(json.loads(row.body)) if answering else None
+                    answering = row_status == 200 or _rejected(row_status)
+                    outcomes.append((row, row_status))
+            else:
+                outcomes = [(row, status) for row in rows]
+            
+            now = datetime.utcnow()
+            ok = True
+            for row, row_status in outcomes:
+                if row_status == 200:
+                    db.session.delete(row)
+                    shipped += 1
+                elif _rejected(row_status):
+                    logger.error(f"Dropping n8n {row.event_type} event {row.id}, rejected with {row_status}")
+                    db.session.delete(row)
+                else:
+                    ok = False
+                    row.attempts += 1
+                    row.last_error = f"Webhook call failed ({row_status or 'no response'})"
+                    row.lease_owner = None
+                    row.lease_expires_at = None
+                    if row.attempts >= N8N_MAX_ATTEMPTS:
+                        logger.error(f"Dropping n8n {row.event_type} event {row.id} after {row.attempts} attempts")
+                        db.session.delete(row)
+                    else:
+                        row.next_attempt_at = now + timedelta(seconds=_retry_delay(row.attempts))
+            db.session.commit()
         
-        if response.status_code == 200:
-            logger.info(f"Successfully triggered n8n workflow for {event_type}")
-            return True
-        else:
-            logger.error(f"Error triggering n8n workflow: {response.status_code} - {response.text}")
+        # Leave the rest for the next scan if n8n is failing
+        if not ok or len(ids) < N8N_BATCH_SIZE:
+            break
+    
+    return shipped
+
+
+def _shed_persisted():
+    """Delete pending events whose type is dropped while the breaker is open."""
+    from app import db
+    from models import N8nEvent
+    
+    dropped = [event_type for event_type, policy in N8N_EVENT_POLICIES.items() if policy == "drop"]
+    if not dropped:
+        return
+    counts = (
+        db.session.query(N8nEvent.event_type, db.func.count(N8nEvent.id))
+        .filter(N8nEvent.event_type.in_(dropped))
+        .group_by(N8nEvent.event_type)
+        .all()
+    )
+    N8nEvent.query.filter(N8nEvent.event_type.in_(dropped)).delete(synchronize_session=False)
+    for event_type, count in counts:
+        _count_shed(event_type, count)
+
+
+def n8n_metrics():
+    """Circuit breaker state, shipper backlog and events shed per type."""
+    with _shed_lock:
+        shed = dict(_shed)
+    return {
+        "breaker": _breaker.metrics(),
+        "queued": _events.qsize(),
+        "shed": shed
+    }
+
+
+def _ship_forever():
+    """Shipper loop: persist each queued batch, then post everything due.
+    
+    Rows left over from a previous run are picked up on the first pass, and
+    failed rows are retried every N8N_RETRY_POLL_SECONDS while idle.
+    """
+    last_scan = None
+    while True:
+        try:
+            batch = _collect_batch()
+            if batch:
+                _persist_events(batch)
+            if batch or last_scan is None or time.monotonic() - last_scan >= N8N_RETRY_POLL_SECONDS:
+                last_scan = time.monotonic()
+                shipped = _ship_pending()
+                if shipped:
+                    logger.info(f"Shipped {shipped} n8n events")
+        except Exception as e:
+            logger.error(f"Error in n8n event shipper: {e}")
+            time.sleep(N8N_FLUSH_SECONDS)
+
+
+async def trigger_workflow_async(event_type, payload):
+    """Trigger an n8n workflow from an async handler without blocking the event loop."""
+    if not N8N_WEBHOOK_URL:
+        logger.warning("N8N_WEBHOOK_URL not set, skipping workflow trigger")
+        return False
+    
+    if not _breaker.allow():
+        if N8N_EVENT_POLICIES.get(event_type, "defer") == "drop":
+            _count_shed(event_type)
             return False
+        # Hand deferred events to the shipper so they go out once n8n recovers
+        return trigger_workflow(event_type, payload)
     
+    try:
+        response = await get_async_client().post(
+            N8N_WEBHOOK_URL,
+            json=_workflow_payload(event_type, payload)
+        )
     except Exception as e:
+        _breaker.record_failure()
         logger.error(f"Error triggering n8n workflow: {e}")
         return False
+    
+    _record_response(response.status_code)
+    if response.status_code == 200:
+        logger.info(f"Successfully triggered n8n workflow for {event_type}")
+        return True
+    logger.error(f"Error triggering n8n workflow: {response.status_code} - {response.text}")
+    return False
 
 
 def send_reminder_notification(user_id, telegram_id, message):
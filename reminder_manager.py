@@ -1,12 +1,18 @@
 import os
 import logging
+import random
 import threading
-import time
 from datetime import datetime, timedelta
 
+from sqlalchemy import case, insert, or_, update
+from sqlalchemy.exc import IntegrityError
+
 from app import db
-from models import User, Reminder
-from n8n_integration import send_reminder_notification
+from models import User, Reminder, ReminderDelivery
+from channels import Notification, fan_out, delivered, optional_channels
+from delivery import LANE_WEIGHTS, lane_for, delivery_running
+from scheduler import ReminderScheduler
+from leases import WORKER_ID, claim_rows
 
 # We'll import the bot application when needed to avoid circular imports
 
@@ -14,90 +20,234 @@ from n8n_integration import send_reminder_notification
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Dictionary to track reminder threads
-reminder_threads = {}
+# Batch settings for claiming due reminders across processes
+DISPATCH_BATCH_SIZE = int(os.environ.get("REMINDER_DISPATCH_BATCH_SIZE", 100))
+DISPATCH_POLL_SECONDS = int(os.environ.get("REMINDER_DISPATCH_POLL_SECONDS", 30))
+EXPIRY_GRACE_MINUTES = int(os.environ.get("REMINDER_EXPIRY_GRACE_MINUTES", 60))
+LOAD_CHUNK_SIZE = 1000
 
+# Only reminders due within the horizon are held in memory; the rest are
+# paged in from the database as the window slides forward
+HORIZON_MINUTES = int(os.environ.get("REMINDER_HORIZON_MINUTES", 15))
+PAGE_INTERVAL_SECONDS = int(os.environ.get("REMINDER_PAGE_INTERVAL_SECONDS", 300))
 
-def send_reminder(reminder_id):
-    """Send a reminder to a user."""
-    from app import app
+# Delivery outbox settings
+OUTBOX_BATCH_SIZE = int(os.environ.get("REMINDER_OUTBOX_BATCH_SIZE", 100))
+OUTBOX_POLL_SECONDS = int(os.environ.get("REMINDER_OUTBOX_POLL_SECONDS", 15))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("REMINDER_OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_BASE_BACKOFF_SECONDS = 10
+OUTBOX_MAX_BACKOFF_SECONDS = 3600
+OUTBOX_RETENTION_DAYS = int(os.environ.get("REMINDER_OUTBOX_RETENTION_DAYS", 7))
+
+# What to do with reminders missed during downtime: skip, once or all
+CATCHUP_POLICY = os.environ.get("REMINDER_CATCHUP_POLICY", "once")
+CATCHUP_AFTER_SECONDS = int(os.environ.get("REMINDER_CATCHUP_AFTER_SECONDS", 300))
+CATCHUP_MAX_OCCURRENCES = int(os.environ.get("REMINDER_CATCHUP_MAX_OCCURRENCES", 24))
+
+# Reminders for the same user due within this many seconds of each other are
+# sent as one digest message; 0 disables coalescing
+COALESCE_SECONDS = int(os.environ.get("REMINDER_COALESCE_SECONDS", 60))
+
+# Single scheduler thread shared by all pending reminders
+scheduler = ReminderScheduler()
+
+# Collapse concurrent wake-ups into one claim loop each
+_dispatch_lock = threading.Lock()
+_dispatch_pending = threading.Event()
+_drain_lock = threading.Lock()
+_drain_pending = threading.Event()
+
+# End of the window currently loaded into the scheduler
+_window_end = None
+_window_lock = threading.Lock()
+
+
+def _lane_priority(reminder_type):
+    """SQL expression for the weight of the delivery lane a reminder type goes to."""
+    return case(LANE_WEIGHTS, value=reminder_type, else_=LANE_WEIGHTS["default"])
+
+
+def next_occurrence(anchor, interval_minutes, now):
+    """Return the first anchor + k * interval (k >= 1) strictly after now.
     
-    with app.app_context():
-        # Get reminder from database
-        reminder = Reminder.query.get(reminder_id)
-        
-        if not reminder or not reminder.active:
-            logger.info(f"Reminder {reminder_id} not found or not active")
-            return False
-        
-        # Get user
-        user = User.query.get(reminder.user_id)
-        
-        if not user or not user.telegram_id:
-            logger.error(f"User for reminder {reminder_id} not found or has no Telegram ID")
-            return False
-        
-        try:
-            # Send notification via Telegram
-            # Import bot inside to avoid circular import
-            try:
-                from bot import application
-                # Check if application is available and initialized
-                if application is not None:
-                    telegram_id = int(user.telegram_id)
-                    application.bot.send_message(
-                        chat_id=telegram_id,
-                        text=reminder.message
-                    )
-                    logger.info(f"Reminder {reminder_id} sent to Telegram {user.telegram_id}")
-                else:
-                    logger.warning("Bot application is None")
-            except (ImportError, AttributeError) as e:
-                logger.warning(f"Bot application not available: {e}")
-            
-            # Also try to send via n8n for redundancy
-            send_reminder_notification(
-                user.id,
-                user.telegram_id,
-                reminder.message
+    Computing from the anchor keeps a repeating reminder on its original
+    grid no matter how late each send runs, and costs O(1) however many
+    occurrences were missed.
+    """
+    interval = timedelta(minutes=interval_minutes)
+    k = max(1, (now - anchor) // interval + 1)
+    return anchor + k * interval
+
+
+def _fire_times(row, now, policy):
+    """Occurrences of a reminder to deliver now under a catch-up policy."""
+    if policy == "skip":
+        return []
+    if policy == "all" and row.repeat_interval:
+        interval = timedelta(minutes=row.repeat_interval)
+        missed = max(0, (now - row.scheduled_time) // interval)
+        first = max(0, missed - CATCHUP_MAX_OCCURRENCES + 1)
+        return [row.scheduled_time + k * interval for k in range(first, missed + 1)]
+    return [row.scheduled_time]
+
+
+def _record_firings(ids, policy="once"):
+    """Record firings for a batch of reminders with one bulk write.
+    
+    Outbox rows are inserted and the reminders advanced (or deactivated,
+    for one-shots) with one executemany each, committed together. Lookups
+    are one query for the reminders and one for already-recorded keys.
+    
+    The policy decides what happens to occurrences a reminder has missed:
+    "once" delivers a single firing, "all" delivers each missed occurrence
+    (up to CATCHUP_MAX_OCCURRENCES), and "skip" delivers nothing and just
+    moves the reminder past now. Returns the number of reminders recorded.
+    """
+    now = datetime.utcnow()
+    rows = db.session.query(
+        Reminder.id, Reminder.user_id, Reminder.type, Reminder.message, Reminder.scheduled_time,
+        Reminder.repeat_interval, Reminder.last_sent_at, User.telegram_id
+    ).join(User, User.id == Reminder.user_id).filter(
+        Reminder.id.in_(ids),
+        Reminder.active == True
+    ).all()
+    
+    fire_times = {row.id: _fire_times(row, now, policy) for row in rows}
+    keys = [f"{row.id}:{fire_time.isoformat()}" for row in rows for fire_time in fire_times[row.id]]
+    existing = set()
+    if keys:
+        existing = {
+            key for (key,) in db.session.query(ReminderDelivery.idempotency_key).filter(
+                ReminderDelivery.idempotency_key.in_(keys)
             )
-            
-            # Update last sent time
-            reminder.last_sent_at = datetime.utcnow()
-            
-            # If repeating, schedule next reminder
-            if reminder.repeat_interval:
-                reminder.scheduled_time = datetime.utcnow() + timedelta(minutes=reminder.repeat_interval)
-            else:
-                # Mark as inactive if non-repeating
-                reminder.active = False
-            
-            db.session.commit()
-            
-            # If repeating, schedule next reminder
-            if reminder.repeat_interval:
-                schedule_reminder(reminder_id)
-            
-            return True
+        }
+    
+    deliveries = []
+    updates = []
+    repeats = []
+    for row in rows:
+        if not row.telegram_id:
+            # Nothing to deliver, but the reminder still advances (or retires)
+            # below so it isn't claimed again on every poll
+            logger.error(f"User for reminder {row.id} has no Telegram ID, skipping this firing")
+            fire_times[row.id] = []
         
-        except Exception as e:
-            logger.error(f"Error sending reminder {reminder_id}: {e}")
-            return False
+        for fire_time in fire_times[row.id]:
+            key = f"{row.id}:{fire_time.isoformat()}"
+            if key in existing:
+                continue
+            deliveries.append({
+                "idempotency_key": key,
+                "reminder_id": row.id,
+                "user_id": row.user_id,
+                "reminder_type": row.type,
+                "priority": LANE_WEIGHTS[lane_for([row.type])],
+                "message": row.message,
+                "fire_time": fire_time,
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "created_at": now
+            })
+        
+        # Repeating reminders move to their next slot on the original grid,
+        # one-shots are retired
+        if row.repeat_interval:
+            next_time = next_occurrence(row.scheduled_time, row.repeat_interval, now)
+            repeats.append((row.id, next_time, dispatch_due_reminders))
+        else:
+            next_time = row.scheduled_time
+        updates.append({
+            "id": row.id,
+            "scheduled_time": next_time,
+            "active": bool(row.repeat_interval),
+            "last_sent_at": now if fire_times[row.id] else row.last_sent_at,
+            "updated_at": now,
+            "lease_owner": None,
+            "lease_expires_at": None
+        })
+    
+    if not updates:
+        return 0
+    
+    try:
+        if deliveries:
+            db.session.execute(insert(ReminderDelivery), deliveries)
+        db.session.execute(update(Reminder), updates)
+        db.session.commit()
+    except IntegrityError:
+        # Another process recorded some of these firings first; their
+        # leases will lapse and the survivors are retried then
+        db.session.rollback()
+        logger.warning(f"Batch of {len(updates)} reminder firings overlapped with another process")
+        return 0
+    
+    # Queue the next occurrence of repeating reminders that fall in the window
+    scheduler.schedule_many(
+        item for item in repeats if _window_end is None or item[1] <= _window_end
+    )
+    scheduler.start()
+    
+    return len(updates)
+
+
+def apply_catchup_policy(policy=None):
+    """Resolve reminders missed while nothing was running, in bulk.
+    
+    Reminders more than CATCHUP_AFTER_SECONDS overdue are leased in chunks
+    and handled per the policy (REMINDER_CATCHUP_POLICY by default) in one
+    write per chunk. Whatever gets delivered goes through the rate-limited
+    outbox, so a restart after an outage doesn't send a burst.
+    Must be called inside an app context. Returns the number handled.
+    """
+    policy = policy or CATCHUP_POLICY
+    if policy not in ("skip", "once", "all"):
+        logger.error(f"Unknown catch-up policy '{policy}', using 'once'")
+        policy = "once"
+    
+    cutoff = datetime.utcnow() - timedelta(seconds=CATCHUP_AFTER_SECONDS)
+    handled = 0
+    while True:
+        ids = claim_rows(
+            Reminder,
+            [Reminder.active == True, Reminder.scheduled_time <= cutoff],
+            Reminder.scheduled_time,
+            LOAD_CHUNK_SIZE
+        )
+        if ids:
+            handled += _record_firings(ids, policy)
+        if len(ids) < LOAD_CHUNK_SIZE:
+            break
+    
+    if handled:
+        logger.info(f"Caught up {handled} missed reminders with policy '{policy}'")
+        if policy != "skip":
+            wake_outbox_drain()
+    return handled
 
 
-def reminder_thread_func(reminder_id, delay_seconds):
-    """Thread function to wait and send a reminder."""
-    logger.info(f"Reminder {reminder_id} scheduled in {delay_seconds} seconds")
+def send_reminder(reminder_id):
+    """Record a reminder firing in the delivery outbox and advance the reminder.
     
-    # Sleep until it's time to send the reminder
-    time.sleep(delay_seconds)
+    The outbox row and the reminder update are committed together, keyed on
+    the reminder id and fire time, so a firing is recorded exactly once.
+    The actual sends happen in drain_outbox.
+    """
+    from app import app
     
-    # Send the reminder
-    send_reminder(reminder_id)
+    with app.app_context():
+        if not _record_firings([reminder_id]):
+            logger.info(f"Reminder {reminder_id} not found, not active or has no recipient")
+            return False
     
-    # Remove thread from tracking dictionary
-    if reminder_id in reminder_threads:
-        del reminder_threads[reminder_id]
+    wake_outbox_drain()
+    return True
+
+
+def wake_outbox_drain():
+    """Ask the scheduler pool to drain the delivery outbox now."""
+    scheduler.schedule("outbox-drain", datetime.utcnow(), drain_outbox)
+    scheduler.start()
 
 
 def schedule_reminder(reminder_id):
@@ -109,51 +259,367 @@ def schedule_reminder(reminder_id):
         reminder = Reminder.query.get(reminder_id)
         
         if not reminder or not reminder.active:
+            scheduler.cancel(reminder_id)
             logger.info(f"Reminder {reminder_id} not found or not active")
             return False
         
-        # Calculate delay in seconds
-        now = datetime.utcnow()
-        
-        if reminder.scheduled_time <= now:
-            # Send immediately
-            send_reminder(reminder_id)
+        # Reminders past the loaded window stay in the database until the
+        # pager reaches them
+        if _window_end is not None and reminder.scheduled_time > _window_end:
+            scheduler.cancel(reminder_id)
+            logger.info(f"Reminder {reminder_id} due {reminder.scheduled_time}, beyond the current window")
             return True
         
-        delay_seconds = (reminder.scheduled_time - now).total_seconds()
-        
-        # Create and start thread
-        thread = threading.Thread(
-            target=reminder_thread_func,
-            args=(reminder_id, delay_seconds),
-            daemon=True
-        )
-        
-        # Store thread in tracking dictionary
-        reminder_threads[reminder_id] = thread
-        
-        # Start the thread
-        thread.start()
+        # Wake the dispatcher when the reminder is due; overdue reminders
+        # are picked up on the next loop iteration. Another process may
+        # claim it first, in which case the wake-up finds nothing to do.
+        scheduler.schedule(reminder_id, reminder.scheduled_time, dispatch_due_reminders)
+        scheduler.start()
         
         logger.info(f"Reminder {reminder_id} scheduled for {reminder.scheduled_time}")
         return True
 
 
+def cancel_reminder(reminder_id):
+    """Drop the pending timer for a reminder, if any."""
+    cancelled = scheduler.cancel(reminder_id)
+    if cancelled:
+        logger.info(f"Reminder {reminder_id} cancelled")
+    return cancelled
+
+
+def reschedule_reminder(reminder_id):
+    """Replace the pending timer for a reminder with one for its current row state.
+    
+    The superseded timer is dropped by the scheduler without touching the
+    database, and inactive reminders simply end up cancelled.
+    """
+    cancel_reminder(reminder_id)
+    return schedule_reminder(reminder_id)
+
+
+def pending_timers(reminder_id=None):
+    """Return how many timers are queued for a reminder, or scheduler-wide stats.
+    
+    More than one timer for a reminder means superseded timers are still
+    waiting in the heap to be discarded.
+    """
+    if reminder_id is None:
+        return scheduler.stats()
+    return scheduler.pending_count(reminder_id)
+
+
+def claim_due_reminders(limit=DISPATCH_BATCH_SIZE):
+    """Atomically lease up to `limit` due reminders for this process.
+    
+    Higher-priority types are claimed first, so a backlog of water pings
+    doesn't hold up medication reminders behind it. With coalescing
+    enabled, reminders for the same users that fall due within the
+    coalescing window are claimed too, so they can go out in the same
+    digest instead of as separate messages a few seconds apart.
+    """
+    now = datetime.utcnow()
+    ids = claim_rows(
+        Reminder,
+        [Reminder.active == True, Reminder.scheduled_time <= now],
+        (_lane_priority(Reminder.type).desc(), Reminder.scheduled_time),
+        limit
+    )
+    
+    if ids and COALESCE_SECONDS > 0:
+        user_ids = db.session.query(Reminder.user_id).filter(Reminder.id.in_(ids)).distinct()
+        ids += claim_rows(
+            Reminder,
+            [
+                Reminder.active == True,
+                Reminder.user_id.in_(user_ids.scalar_subquery()),
+                Reminder.scheduled_time <= now + timedelta(seconds=COALESCE_SECONDS)
+            ],
+            Reminder.scheduled_time,
+            limit
+        )
+    
+    return ids
+
+
+def dispatch_due_reminders():
+    """Claim and send due reminders in batches until none are left.
+    
+    Wake-ups that arrive while a dispatch is running are folded into one
+    more pass instead of starting parallel claim loops.
+    """
+    from app import app
+    
+    _dispatch_pending.set()
+    if not _dispatch_lock.acquire(blocking=False):
+        return 0
+    
+    sent = 0
+    try:
+        while _dispatch_pending.is_set():
+            _dispatch_pending.clear()
+            while True:
+                # Record the whole batch in one transaction before waking
+                # the outbox, so firings for the same user land in one drain
+                # and can be coalesced
+                with app.app_context():
+                    ids = claim_due_reminders()
+                    if ids:
+                        sent += _record_firings(ids)
+                if ids:
+                    wake_outbox_drain()
+                
+                if len(ids) < DISPATCH_BATCH_SIZE:
+                    break
+    finally:
+        _dispatch_lock.release()
+    
+    if sent:
+        logger.info(f"Dispatched {sent} reminders from {WORKER_ID}")
+    return sent
+
+
+def _retry_delay(attempts):
+    """Exponential backoff with jitter for the given attempt count."""
+    delay = min(OUTBOX_MAX_BACKOFF_SECONDS, OUTBOX_BASE_BACKOFF_SECONDS * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _record_failure(delivery, error, now):
+    """Count a failed attempt and schedule the retry, or give up."""
+    delivery.attempts += 1
+    delivery.last_error = str(error)
+    delivery.lease_owner = None
+    delivery.lease_expires_at = None
+    if delivery.attempts >= OUTBOX_MAX_ATTEMPTS:
+        delivery.status = 'failed'
+        logger.error(f"Giving up on delivery {delivery.idempotency_key} after {delivery.attempts} attempts: {error}")
+    else:
+        delivery.next_attempt_at = now + timedelta(seconds=_retry_delay(delivery.attempts))
+        logger.warning(f"Delivery {delivery.idempotency_key} failed (attempt {delivery.attempts}): {error}")
+
+
+def _channels_sent(delivery):
+    return set(filter(None, (delivery.channels_sent or "").split(",")))
+
+
+def _coalesce(deliveries):
+    """Group deliveries per user whose fire times fall within COALESCE_SECONDS of the group's first.
+    
+    Only deliveries that already went out over the same channels are
+    grouped, so a digest never repeats a reminder on a channel.
+    """
+    groups = []
+    for delivery in sorted(deliveries, key=lambda d: (d.user_id, d.channels_sent or "", d.fire_time, d.id)):
+        if groups:
+            first = groups[-1][0]
+            if (first.user_id == delivery.user_id and
+                    (first.channels_sent or "") == (delivery.channels_sent or "") and
+                    (delivery.fire_time - first.fire_time).total_seconds() <= COALESCE_SECONDS):
+                groups[-1].append(delivery)
+                continue
+        groups.append([delivery])
+    return groups
+
+
+def _digest_text(group):
+    """Message text for a group of deliveries: the reminder itself, or a digest."""
+    if len(group) == 1:
+        return group[0].message
+    lines = "\n".join(f"• {delivery.message}" for delivery in group)
+    return f"🔔 You have {len(group)} reminders:\n\n{lines}"
+
+
+def _deliver_batch(ids):
+    """Send one claimed batch of outbox rows and record the outcome of each."""
+    deliveries = ReminderDelivery.query.filter(ReminderDelivery.id.in_(ids)).all()
+    user_ids = {delivery.user_id for delivery in deliveries}
+    users = {user.id: user for user in User.query.filter(User.id.in_(user_ids))}
+    
+    now = datetime.utcnow()
+    groups = []
+    for group in _coalesce(deliveries):
+        user = users.get(group[0].user_id)
+        if not user or not user.telegram_id:
+            for delivery in group:
+                _record_failure(delivery, "User not found or has no Telegram ID", now)
+            continue
+        # Retries only go to required channels that haven't succeeded yet
+        skip = _channels_sent(group[0])
+        if group[0].attempts:
+            skip |= optional_channels()
+        groups.append((group, Notification(
+            user.id,
+            user.telegram_id,
+            _digest_text(group),
+            lane_for([delivery.reminder_type for delivery in group]),
+            skip
+        )))
+    
+    # Fan the whole batch out over every channel at once. Deliveries
+    # coalesced into one digest share its outcome.
+    results = fan_out([notification for _, notification in groups])
+    
+    now = datetime.utcnow()
+    sent = 0
+    for (group, _), channel_results in zip(groups, results):
+        channels_sent = _channels_sent(group[0]) | {result.channel for result in channel_results if result.ok}
+        for delivery in group:
+            delivery.channels_sent = ",".join(sorted(channels_sent)) or None
+        if delivered(channel_results):
+            for delivery in group:
+                delivery.status = 'sent'
+                delivery.sent_at = now
+                delivery.attempts += 1
+                delivery.lease_owner = None
+                delivery.lease_expires_at = None
+                sent += 1
+        else:
+            error = "; ".join(
+                f"{result.channel}: {result.error}" for result in channel_results
+                if result.required and not result.ok
+            )
+            for delivery in group:
+                _record_failure(delivery, error, now)
+    
+    db.session.commit()
+    return sent
+
+
+def drain_outbox():
+    """Deliver pending outbox rows in batches until none are due.
+    
+    Like dispatch_due_reminders, overlapping wake-ups are folded into one
+    more pass, and rows are leased so several processes can drain at once.
+    """
+    from app import app
+    
+    # Rows claimed here would fail the Telegram channel outright and burn
+    # their attempts; leave them for a process running the bot
+    if not delivery_running():
+        return 0
+    
+    _drain_pending.set()
+    if not _drain_lock.acquire(blocking=False):
+        return 0
+    
+    sent = 0
+    try:
+        while _drain_pending.is_set():
+            _drain_pending.clear()
+            while True:
+                with app.app_context():
+                    now = datetime.utcnow()
+                    # Highest lane first, so the weighted lanes see every
+                    # due medication row before older low-priority ones
+                    ids = claim_rows(
+                        ReminderDelivery,
+                        [ReminderDelivery.status == 'pending', ReminderDelivery.next_attempt_at <= now],
+                        (ReminderDelivery.priority.desc(), ReminderDelivery.next_attempt_at),
+                        OUTBOX_BATCH_SIZE
+                    )
+                    if ids:
+                        sent += _deliver_batch(ids)
+                
+                if len(ids) < OUTBOX_BATCH_SIZE:
+                    break
+    finally:
+        _drain_lock.release()
+    
+    if sent:
+        logger.info(f"Delivered {sent} reminders from the outbox")
+    return sent
+
+
+def _every(key, seconds, func):
+    """Run func now and then every `seconds` on the scheduler."""
+    def run():
+        try:
+            func()
+        finally:
+            scheduler.schedule(key, datetime.utcnow() + timedelta(seconds=seconds), run)
+    
+    if not scheduler.is_scheduled(key):
+        scheduler.schedule(key, datetime.utcnow(), run)
+
+
+def _load_window(start, end):
+    """Stream active reminders due in (start, end] onto the scheduler.
+    
+    A start of None loads everything up to end, including overdue rows,
+    which are counted and handed to the dispatcher with one wake-up.
+    Returns (scheduled, overdue).
+    """
+    now = datetime.utcnow()
+    query = db.session.query(Reminder.id, Reminder.scheduled_time).filter(
+        Reminder.active == True,
+        Reminder.scheduled_time <= end
+    )
+    if start is not None:
+        query = query.filter(Reminder.scheduled_time > start)
+    rows = query.order_by(Reminder.scheduled_time).execution_options(yield_per=LOAD_CHUNK_SIZE)
+    
+    count = 0
+    overdue = 0
+    chunk = []
+    for reminder_id, scheduled_time in rows:
+        if scheduled_time <= now:
+            overdue += 1
+            continue
+        chunk.append((reminder_id, scheduled_time, dispatch_due_reminders))
+        if len(chunk) >= LOAD_CHUNK_SIZE:
+            count += scheduler.schedule_many(chunk)
+            chunk = []
+    count += scheduler.schedule_many(chunk)
+    
+    if overdue:
+        scheduler.schedule("dispatch-overdue", now, dispatch_due_reminders)
+    
+    return count, overdue
+
+
+def page_in_reminders():
+    """Slide the in-memory window forward and load the reminders it now covers."""
+    global _window_end
+    from app import app
+    
+    with _window_lock:
+        new_end = datetime.utcnow() + timedelta(minutes=HORIZON_MINUTES)
+        with app.app_context():
+            count, _ = _load_window(_window_end, new_end)
+        _window_end = new_end
+    logger.debug(f"Paged in {count} reminders up to {new_end}")
+
+
 def schedule_all_reminders():
-    """Schedule all active reminders from the database."""
+    """Schedule active reminders due within the horizon.
+    
+    Rows are streamed from one range query on (active, scheduled_time) and
+    pushed straight onto the scheduler. Overdue reminders are not sent here;
+    a single dispatcher wake-up on the scheduler pool handles them. Later
+    reminders are loaded by page_in_reminders as the window moves.
+    """
+    global _window_end
     from app import app
     
-    with app.app_context():
-        # Get all active reminders
-        reminders = Reminder.query.filter_by(active=True).all()
-        
-        count = 0
-        for reminder in reminders:
-            if schedule_reminder(reminder.id):
-                count += 1
-        
-        logger.info(f"Scheduled {count} reminders")
-        return count
+    with _window_lock:
+        end = datetime.utcnow() + timedelta(minutes=HORIZON_MINUTES)
+        # Set before catching up so repeats it advances past the window
+        # stay in the database instead of all landing on the heap
+        _window_end = end
+        with app.app_context():
+            apply_catchup_policy()
+            count, overdue = _load_window(None, end)
+    
+    # Sweep regularly so reminders created by another worker, or left behind
+    # by one that died, are still sent, and retry failed deliveries
+    _every("dispatch-poll", DISPATCH_POLL_SECONDS, dispatch_due_reminders)
+    _every("outbox-poll", OUTBOX_POLL_SECONDS, drain_outbox)
+    _every("page-window", PAGE_INTERVAL_SECONDS, page_in_reminders)
+    scheduler.start()
+    
+    logger.info(f"Scheduled {count} reminders, {overdue} overdue queued for dispatch")
+    return count + overdue
 
 
 def cleanup_expired_reminders():
@@ -161,18 +627,26 @@ def cleanup_expired_reminders():
     from app import app
     
     with app.app_context():
-        # Find expired non-repeating reminders
+        # Find expired non-repeating reminders. Recently missed ones are left
+        # for the dispatcher, and so are ones another process is sending.
         now = datetime.utcnow()
         expired_reminders = Reminder.query.filter(
             Reminder.repeat_interval.is_(None),
-            Reminder.scheduled_time < now,
-            Reminder.active == True
+            Reminder.scheduled_time < now - timedelta(minutes=EXPIRY_GRACE_MINUTES),
+            Reminder.active == True,
+            or_(Reminder.lease_expires_at.is_(None), Reminder.lease_expires_at < now)
         ).all()
         
         # Mark as inactive
         for reminder in expired_reminders:
             reminder.active = False
         
+        # Drop finished outbox rows past the retention period
+        ReminderDelivery.query.filter(
+            ReminderDelivery.status.in_(['sent', 'failed']),
+            ReminderDelivery.created_at < now - timedelta(days=OUTBOX_RETENTION_DAYS)
+        ).delete(synchronize_session=False)
+        
         db.session.commit()
         
         logger.info(f"Cleaned up {len(expired_reminders)} expired reminders")
@@ -12,9 +12,14 @@ from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationE
 from app import app, db
 from models import User, Task, Reminder, CalendarEvent
 from calendar_integration import get_auth_url, process_oauth_callback, get_upcoming_events
-from supabase_client import sync_user_to_supabase, sync_task_to_supabase, sync_reminder_to_supabase
-from n8n_integration import trigger_workflow
-from reminder_manager import schedule_reminder, schedule_all_reminders, cleanup_expired_reminders
+from calendar_refresher import mark_user_active
+from supabase_client import queue_user_sync, queue_task_sync, queue_reminder_sync
+from n8n_integration import trigger_workflow, n8n_metrics
+from delivery import delivery_metrics
+from reminder_manager import (
+    schedule_reminder, reschedule_reminder, cancel_reminder,
+    schedule_all_reminders, cleanup_expired_reminders, pending_timers
+)
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -100,16 +105,13 @@ def register():
         existing_user.password_hash = generate_password_hash(form.password.data)
         db.session.commit()
         
-        # Sync to Supabase if needed
-        try:
-            sync_user_to_supabase(
-                existing_user.id,
-                existing_user.telegram_id,
-                existing_user.email,
-                existing_user.username
-            )
-        except Exception as e:
-            logger.error(f"Error syncing user to Supabase: {e}")
+        # Sync to Supabase in the background
+        queue_user_sync(
+            existing_user.id,
+            existing_user.telegram_id,
+            existing_user.email,
+            existing_user.username
+        )
         
         # Instead of logging the user in, redirect to login page with a success message
         flash('Registration completed successfully! Please log in with your new account.', 'success')
@@ -182,6 +184,8 @@ def logout():
 @login_required
 def dashboard():
     """User dashboard route."""
+    mark_user_active(current_user)
+    
     # Get user's tasks
     tasks = Task.query.filter_by(user_id=current_user.id, completed=False).order_by(Task.due_date).all()
     
@@ -312,8 +316,8 @@ def add_task():
     db.session.add(task)
     db.session.commit()
     
-    # Sync to Supabase
-    sync_task_to_supabase(
+    # Sync to Supabase in the background
+    queue_task_sync(
         task.id,
         current_user.id,
         task.title,
@@ -339,8 +343,8 @@ def add_task():
         # Schedule the reminder
         schedule_reminder(reminder.id)
         
-        # Sync to Supabase
-        sync_reminder_to_supabase(
+        # Sync to Supabase in the background
+        queue_reminder_sync(
             reminder.id,
             current_user.id,
             reminder.type,
@@ -367,8 +371,8 @@ def complete_task(task_id):
     task.completed = True
     db.session.commit()
     
-    # Sync to Supabase
-    sync_task_to_supabase(
+    # Sync to Supabase in the background
+    queue_task_sync(
         task.id,
         current_user.id,
         task.title,
@@ -406,11 +410,11 @@ def add_water_reminder():
         existing.scheduled_time = datetime.utcnow() + timedelta(minutes=interval)
         db.session.commit()
         
-        # Reschedule the reminder
-        schedule_reminder(existing.id)
+        # Reschedule the reminder, superseding the pending timer
+        reschedule_reminder(existing.id)
         
-        # Sync to Supabase
-        sync_reminder_to_supabase(
+        # Sync to Supabase in the background
+        queue_reminder_sync(
             existing.id,
             current_user.id,
             existing.type,
@@ -437,8 +441,8 @@ def add_water_reminder():
         # Schedule the reminder
         schedule_reminder(reminder.id)
         
-        # Sync to Supabase
-        sync_reminder_to_supabase(
+        # Sync to Supabase in the background
+        queue_reminder_sync(
             reminder.id,
             current_user.id,
             reminder.type,
@@ -468,14 +472,18 @@ def toggle_reminder(reminder_id):
     if reminder.active:
         # Set next scheduled time if activating
         reminder.scheduled_time = datetime.utcnow() + timedelta(minutes=reminder.repeat_interval or 60)
-        
-        # Schedule the reminder
-        schedule_reminder(reminder.id)
     
     db.session.commit()
     
-    # Sync to Supabase
-    sync_reminder_to_supabase(
+    if reminder.active:
+        # Schedule after committing so the scheduler sees the new time; it is
+        # only held in memory if due within the current window
+        reschedule_reminder(reminder.id)
+    else:
+        cancel_reminder(reminder.id)
+    
+    # Sync to Supabase in the background
+    queue_reminder_sync(
         reminder.id,
         current_user.id,
         reminder.type,
@@ -520,6 +528,63 @@ def api_send_reminder(reminder_id):
     return jsonify({"success": success})
 
 
+@app.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    """API endpoint exposing reminder scheduler, delivery and n8n metrics."""
+    api_key = request.headers.get('X-API-Key')
+    expected_key = os.environ.get('API_KEY')
+    
+    if not expected_key or api_key != expected_key:
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    stats = pending_timers()
+    
+    return jsonify({
+        "scheduler": {
+            "live": stats["live"],
+            "heap": stats["heap"],
+            "stale": stats["stale"],
+            # JSON object keys must be strings
+            "duplicates": {str(key): count for key, count in stats["duplicates"].items()}
+        },
+        # Per priority lane; null when the bot isn't running in this worker
+        "delivery": delivery_metrics(),
+        "n8n": n8n_metrics()
+    })
+
+
+@app.route('/api/reconcile_supabase', methods=['POST'])
+def api_reconcile_supabase():
+    """API endpoint starting a background job that repairs drift between the database and Supabase."""
+    api_key = request.headers.get('X-API-Key')
+    expected_key = os.environ.get('API_KEY')
+    
+    if not expected_key or api_key != expected_key:
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    from supabase_reconcile import start_reconcile, reconcile_status
+    dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+    
+    if not start_reconcile(dry_run=dry_run):
+        return jsonify({"success": False, "error": "Already running", "run": reconcile_status()}), 409
+    
+    return jsonify({"success": True, "run": reconcile_status()}), 202
+
+
+@app.route('/api/reconcile_supabase', methods=['GET'])
+def api_reconcile_supabase_status():
+    """API endpoint reporting the latest reconciliation run started by this worker."""
+    api_key = request.headers.get('X-API-Key')
+    expected_key = os.environ.get('API_KEY')
+    
+    if not expected_key or api_key != expected_key:
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    from supabase_reconcile import reconcile_status
+    
+    return jsonify({"run": reconcile_status()})
+
+
 @app.route('/api/telegram_webhook', methods=['POST'])
 def telegram_webhook():
     """API endpoint for Telegram webhook."""
@@ -0,0 +1,213 @@
+import heapq
+import itertools
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    """A single scheduled callback in the heap."""
+
+    __slots__ = ("when", "generation", "key", "callback")
+
+    def __init__(self, when, generation, key, callback):
+        self.when = when
+        self.generation = generation
+        self.key = key
+        self.callback = callback
+
+    def __lt__(self, other):
+        return (self.when, self.generation) < (other.when, other.generation)
+
+
+class ReminderScheduler:
+    """Run callbacks at given UTC times from one thread backed by a min-heap.
+
+    Every schedule gets a new generation number, and a key's live generation
+    is the only one allowed to fire. Rescheduling or cancelling a key just
+    moves or clears its live generation; superseded heap entries are dropped
+    in O(1) when they reach the top, so they never run their callback.
+    Due callbacks run on a small fixed pool so a slow callback can't hold up
+    the timer loop.
+    """
+
+    def __init__(self, name="reminder-scheduler", workers=4):
+        self.name = name
+        self._heap = []
+        self._live = {}
+        self._pending = Counter()
+        self._generations = itertools.count(1)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+    def start(self):
+        """Start the scheduler thread if it isn't running yet."""
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the scheduler thread. Pending entries are kept."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def schedule(self, key, when, callback):
+        """Run callback() at the naive UTC datetime `when`, superseding any pending entry for key.
+
+        Returns a (key, generation) handle that can be passed to cancel().
+        """
+        with self._cond:
+            entry = self._push(key, when, callback)
+            self._maybe_compact()
+        return key, entry.generation
+
+    def schedule_many(self, items):
+        """Schedule (key, when, callback) tuples under one lock acquisition."""
+        count = 0
+        with self._cond:
+            for key, when, callback in items:
+                self._push(key, when, callback)
+                count += 1
+            self._maybe_compact()
+        return count
+
+    def reschedule(self, key, when):
+        """Move the pending entry for key to a new time, keeping its callback.
+
+        Returns the new handle, or None if nothing was pending for key.
+        """
+        with self._cond:
+            entry = self._live.get(key)
+            if entry is None:
+                return None
+            entry = self._push(key, when, entry.callback)
+            self._maybe_compact()
+        return key, entry.generation
+
+    def cancel(self, key, generation=None):
+        """Cancel the pending entry for key in O(1).
+
+        If a generation is given, only that schedule is cancelled, so an
+        old handle can't cancel a newer one. Returns True if one was pending.
+        """
+        with self._cond:
+            entry = self._live.get(key)
+            if entry is None or (generation is not None and entry.generation != generation):
+                return False
+            del self._live[key]
+            self._maybe_compact()
+            return True
+
+    def is_scheduled(self, key):
+        """Return True if key has a live entry."""
+        with self._cond:
+            return key in self._live
+
+    def pending_count(self, key):
+        """Number of heap entries for key, superseded ones included.
+
+        Anything above 1 means stale timers are still waiting to be dropped.
+        """
+        with self._cond:
+            return self._pending.get(key, 0)
+
+    def stats(self):
+        """Return live/stale entry counts and the keys with superseded timers."""
+        with self._cond:
+            return {
+                "live": len(self._live),
+                "heap": len(self._heap),
+                "stale": len(self._heap) - len(self._live),
+                "duplicates": {key: n for key, n in self._pending.items() if n > 1},
+            }
+
+    def __len__(self):
+        with self._cond:
+            return len(self._live)
+
+    def _push(self, key, when, callback):
+        """Push a new live entry for key. Lock must be held."""
+        entry = _Entry(when, next(self._generations), key, callback)
+        self._live[key] = entry
+        self._pending[key] += 1
+        heapq.heappush(self._heap, entry)
+        # Only wake the loop if the new entry is now the earliest one
+        if self._heap[0] is entry:
+            self._cond.notify()
+        return entry
+
+    def _is_stale(self, entry):
+        live = self._live.get(entry.key)
+        return live is None or live.generation != entry.generation
+
+    def _forget(self, entry):
+        """Drop the pending count for an entry that left the heap."""
+        remaining = self._pending[entry.key] - 1
+        if remaining:
+            self._pending[entry.key] = remaining
+        else:
+            del self._pending[entry.key]
+
+    def _maybe_compact(self):
+        """Rebuild the heap once stale entries outnumber live ones."""
+        if len(self._heap) > 2 * len(self._live) + 64:
+            live = []
+            for entry in self._heap:
+                if self._is_stale(entry):
+                    self._forget(entry)
+                else:
+                    live.append(entry)
+            heapq.heapify(live)
+            self._heap = live
+
+    def _pop_due(self, now):
+        """Pop the next due live entry, or return the seconds to wait for one."""
+        while self._heap:
+            entry = self._heap[0]
+            if self._is_stale(entry):
+                heapq.heappop(self._heap)
+                self._forget(entry)
+                continue
+            delay = (entry.when - now).total_seconds()
+            if delay > 0:
+                return None, delay
+            heapq.heappop(self._heap)
+            self._forget(entry)
+            del self._live[entry.key]
+            return entry, 0
+        return None, None
+
+    def _run_callback(self, entry):
+        """Run a due callback, logging instead of raising on failure."""
+        try:
+            entry.callback()
+        except Exception as e:
+            logger.error(f"Error running scheduled callback for {entry.key}: {e}")
+
+    def _run(self):
+        """Scheduler loop: sleep until the earliest entry is due, then hand it to the pool."""
+        logger.info(f"Scheduler {self.name} started")
+        while True:
+            with self._cond:
+                if self._stopped:
+                    break
+                entry, delay = self._pop_due(datetime.utcnow())
+                if entry is None:
+                    self._cond.wait(timeout=delay)
+                    continue
+
+            self._executor.submit(self._run_callback, entry)
+
+        logger.info(f"Scheduler {self.name} stopped")
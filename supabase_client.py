@@ -1,5 +1,10 @@
 import os
 import logging
+import random
+import threading
+import time
+from datetime import datetime
+from postgrest import ReturnMethod
 from supabase import create_client, Client
 
 # Configure logging
@@ -10,9 +15,29 @@ logger = logging.getLogger(__name__)
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
 
+# Rows per upsert request in the bulk sync functions
+SUPABASE_UPSERT_CHUNK = int(os.environ.get("SUPABASE_UPSERT_CHUNK", 500))
+
+# Write-behind queue: changes are held per entity, latest state wins, and
+# flushed as bulk upserts on a timer
+SUPABASE_FLUSH_SECONDS = float(os.environ.get("SUPABASE_FLUSH_SECONDS", 2))
+SUPABASE_MAX_BACKOFF_SECONDS = 300
+
+# Upsert key for each synced table
+CONFLICT_KEYS = {
+    "users": "telegram_id",
+    "tasks": "app_task_id",
+    "reminders": "app_reminder_id"
+}
+
 # Global client
 supabase: Client = None
 
+# table -> conflict key -> latest row waiting to be flushed
+_pending = {table: {} for table in CONFLICT_KEYS}
+_pending_lock = threading.Lock()
+_flusher = None
+
 
 def get_supabase_client() -> Client:
     """Get or create a Supabase client."""
@@ -29,115 +54,197 @@ def get_supabase_client() -> Client:
     return supabase
 
 
-def sync_user_to_supabase(user_id, telegram_id, email, username):
-    """Sync a user to Supabase."""
+def user_row(user_id, telegram_id, email, username):
+    """Build a Supabase users row."""
+    return {
+        "app_user_id": user_id,
+        "telegram_id": telegram_id,
+        "email": email,
+        "username": username
+    }
+
+
+def task_row(task_id, user_id, title, description, due_date, priority, completed):
+    """Build a Supabase tasks row."""
+    return {
+        "app_task_id": task_id,
+        "app_user_id": user_id,
+        "title": title,
+        "description": description,
+        "due_date": due_date.isoformat() if due_date else None,
+        "priority": priority,
+        "completed": completed
+    }
+
+
+def reminder_row(reminder_id, user_id, reminder_type, message, scheduled_time, repeat_interval, active):
+    """Build a Supabase reminders row."""
+    return {
+        "app_reminder_id": reminder_id,
+        "app_user_id": user_id,
+        "type": reminder_type,
+        "message": message,
+        "scheduled_time": scheduled_time.isoformat() if scheduled_time else None,
+        "repeat_interval": repeat_interval,
+        "active": active
+    }
+
+
+def upsert_rows(table, rows, on_conflict):
+    """Insert or update rows in one request per chunk, keyed on a unique column.
+    
+    The conflict column needs a unique constraint in Supabase. If the same
+    key appears more than once the last row wins, since Postgres refuses to
+    update a row twice in one statement. Returns the number of rows sent.
+    """
+    latest = {}
+    for row in rows:
+        latest[row[on_conflict]] = row
+    rows = list(latest.values())
+    if not rows:
+        return 0
+    
+    client = get_supabase_client()
+    last_sync = datetime.utcnow().isoformat()
+    for start in range(0, len(rows), SUPABASE_UPSERT_CHUNK):
+        chunk = [dict(row, last_sync=last_sync) for row in rows[start:start + SUPABASE_UPSERT_CHUNK]]
+        client.table(table).upsert(
+            chunk,
+            on_conflict=on_conflict,
+            returning=ReturnMethod.minimal
+        ).execute()
+    
+    return len(rows)
+
+
+def sync_users_to_supabase(rows):
+    """Upsert a list of user_row() dicts to Supabase."""
     try:
-        client = get_supabase_client()
-        
-        # Check if user exists in Supabase
-        resp = client.table("users").select("*").eq("telegram_id", telegram_id).execute()
-        
-        if len(resp.data) > 0:
-            # Update existing user
-            supabase_user_id = resp.data[0]["id"]
-            client.table("users").update({
-                "email": email,
-                "username": username,
-                "last_sync": "now()"
-            }).eq("id", supabase_user_id).execute()
-            logger.info(f"Updated user {telegram_id} in Supabase")
-        else:
-            # Create new user
-            client.table("users").insert({
-                "app_user_id": user_id,
-                "telegram_id": telegram_id,
-                "email": email,
-                "username": username
-            }).execute()
-            logger.info(f"Created user {telegram_id} in Supabase")
-        
+        count = upsert_rows("users", rows, CONFLICT_KEYS["users"])
+        logger.info(f"Synced {count} users to Supabase")
         return True
     
     except Exception as e:
-        logger.error(f"Error syncing user to Supabase: {e}")
+        logger.error(f"Error syncing users to Supabase: {e}")
         return False
 
 
-def sync_task_to_supabase(task_id, user_id, title, description, due_date, priority, completed):
-    """Sync a task to Supabase."""
+def sync_tasks_to_supabase(rows):
+    """Upsert a list of task_row() dicts to Supabase."""
     try:
-        client = get_supabase_client()
-        
-        # Check if task exists in Supabase
-        resp = client.table("tasks").select("*").eq("app_task_id", task_id).execute()
-        
-        if len(resp.data) > 0:
-            # Update existing task
-            supabase_task_id = resp.data[0]["id"]
-            client.table("tasks").update({
-                "title": title,
-                "description": description,
-                "due_date": due_date.isoformat() if due_date else None,
-                "priority": priority,
-                "completed": completed,
-                "last_sync": "now()"
-            }).eq("id", supabase_task_id).execute()
-            logger.info(f"Updated task {task_id} in Supabase")
-        else:
-            # Create new task
-            client.table("tasks").insert({
-                "app_task_id": task_id,
-                "app_user_id": user_id,
-                "title": title,
-                "description": description,
-                "due_date": due_date.isoformat() if due_date else None,
-                "priority": priority,
-                "completed": completed
-            }).execute()
-            logger.info(f"Created task {task_id} in Supabase")
-        
+        count = upsert_rows("tasks", rows, CONFLICT_KEYS["tasks"])
+        logger.info(f"Synced {count} tasks to Supabase")
         return True
     
     except Exception as e:
-        logger.error(f"Error syncing task to Supabase: {e}")
+        logger.error(f"Error syncing tasks to Supabase: {e}")
         return False
 
 
-def sync_reminder_to_supabase(reminder_id, user_id, reminder_type, message, scheduled_time, repeat_interval, active):
-    """Sync a reminder to Supabase."""
+def sync_reminders_to_supabase(rows):
+    """Upsert a list of reminder_row() dicts to Supabase."""
     try:
-        client = get_supabase_client()
-        
-        # Check if reminder exists in Supabase
-        resp = client.table("reminders").select("*").eq("app_reminder_id", reminder_id).execute()
-        
-        if len(resp.data) > 0:
-            # Update existing reminder
-            supabase_reminder_id = resp.data[0]["id"]
-            client.table("reminders").update({
-                "type": reminder_type,
-                "message": message,
-                "scheduled_time": scheduled_time.isoformat() if scheduled_time else None,
-                "repeat_interval": repeat_interval,
-                "active": active,
-                "last_sync": "now()"
-            }).eq("id", supabase_reminder_id).execute()
-            logger.info(f"Updated reminder {reminder_id} in Supabase")
-        else:
-            # Create new reminder
-            client.table("reminders").insert({
-                "app_reminder_id": reminder_id,
-                "app_user_id": user_id,
-                "type": reminder_type,
-                "message": message,
-                "scheduled_time": scheduled_time.isoformat() if scheduled_time else None,
-                "repeat_interval": repeat_interval,
-                "active": active
-            }).execute()
-            logger.info(f"Created reminder {reminder_id} in Supabase")
-        
+        count = upsert_rows("reminders", rows, CONFLICT_KEYS["reminders"])
+        logger.info(f"Synced {count} reminders to Supabase")
         return True
     
     except Exception as e:
-        logger.error(f"Error syncing reminder to Supabase: {e}")
+        logger.error(f"Error syncing reminders to Supabase: {e}")
         return False
+
+
+def sync_user_to_supabase(user_id, telegram_id, email, username):
+    """Sync a user to Supabase."""
+    return sync_users_to_supabase([user_row(user_id, telegram_id, email, username)])
+
+
+def sync_task_to_supabase(task_id, user_id, title, description, due_date, priority, completed):
+    """Sync a task to Supabase."""
+    return sync_tasks_to_supabase([
+        task_row(task_id, user_id, title, description, due_date, priority, completed)
+    ])
+
+
+def sync_reminder_to_supabase(reminder_id, user_id, reminder_type, message, scheduled_time, repeat_interval, active):
+    """Sync a reminder to Supabase."""
+    return sync_reminders_to_supabase([
+        reminder_row(reminder_id, user_id, reminder_type, message, scheduled_time, repeat_interval, active)
+    ])
+
+
+def _queue(table, row):
+    """Hold a row for the next flush, replacing any queued row for the same entity.
+    
+    Does nothing when Supabase isn't configured, so rows don't pile up
+    with nowhere to go.
+    """
+    global _flusher
+    
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        return
+    
+    with _pending_lock:
+        _pending[table][row[CONFLICT_KEYS[table]]] = row
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_forever, name="supabase-sync", daemon=True)
+            _flusher.start()
+
+
+def queue_user_sync(user_id, telegram_id, email, username):
+    """Queue a user for write-behind sync to Supabase."""
+    _queue("users", user_row(user_id, telegram_id, email, username))
+
+
+def queue_task_sync(task_id, user_id, title, description, due_date, priority, completed):
+    """Queue a task for write-behind sync to Supabase."""
+    _queue("tasks", task_row(task_id, user_id, title, description, due_date, priority, completed))
+
+
+def queue_reminder_sync(reminder_id, user_id, reminder_type, message, scheduled_time, repeat_interval, active):
+    """Queue a reminder for write-behind sync to Supabase."""
+    _queue("reminders", reminder_row(
+        reminder_id, user_id, reminder_type, message, scheduled_time, repeat_interval, active
+    ))
+
+
+def flush_sync_queue():
+    """Upsert everything queued so far, one bulk request per table and chunk.
+    
+    Rows that fail go back in the queue unless a newer version of the same
+    entity was queued meanwhile. Returns True if every table was flushed.
+    """
+    with _pending_lock:
+        batches = {table: rows for table, rows in _pending.items() if rows}
+        for table in batches:
+            _pending[table] = {}
+    
+    ok = True
+    for table, rows in batches.items():
+        try:
+            count = upsert_rows(table, list(rows.values()), CONFLICT_KEYS[table])
+            logger.info(f"Flushed {count} {table} to Supabase")
+        except Exception as e:
+            logger.error(f"Error flushing {table} to Supabase: {e}")
+            ok = False
+            with _pending_lock:
+                for key, row in rows.items():
+                    _pending[table].setdefault(key, row)
+    
+    return ok
+
+
+def _flush_forever():
+    """Flush the queue on a timer, backing off with jitter while Supabase is failing."""
+    failures = 0
+    while True:
+        if failures:
+            delay = min(SUPABASE_MAX_BACKOFF_SECONDS, SUPABASE_FLUSH_SECONDS * 2 ** failures)
+            time.sleep(delay * random.uniform(0.5, 1.0))
+        else:
+            time.sleep(SUPABASE_FLUSH_SECONDS)
+        
+        try:
+            failures = 0 if flush_sync_queue() else failures + 1
+        except Exception as e:
+            logger.error(f"Error in Supabase sync flusher: {e}")
+            failures += 1
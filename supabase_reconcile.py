@@ -0,0 +1,297 @@
+import os
+import calendar
+import hashlib
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import BigInteger, cast, func, literal_column
+
+from app import db
+from models import User, Task, Reminder
+from supabase_client import CONFLICT_KEYS, get_supabase_client, upsert_rows
+from supabase_replication import REPLICATED_TABLES
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Buckets start this wide (in ids), are split FANOUT ways on each mismatch and
+# compared row by row once they are LEAF_SIZE ids wide or less
+RECONCILE_TOP_BUCKET = int(os.environ.get("SUPABASE_RECONCILE_TOP_BUCKET", 65536))
+RECONCILE_FANOUT = 16
+RECONCILE_LEAF_SIZE = 256
+MAX_KEY = 2 ** 62
+
+FIELD_SEPARATOR = "\x1f"
+NULL = "\\N"
+
+# Per table: local key column, Supabase key column, then (local column,
+# Supabase column, kind) for every replicated field. Both sides hash the
+# fields in this order with the same canonical text form.
+RECONCILED_TABLES = {
+    "users": (User.id, "app_user_id", [
+        (User.id, "app_user_id", "int"),
+        (User.telegram_id, "telegram_id", "text"),
+        (User.email, "email", "text"),
+        (User.username, "username", "text"),
+    ]),
+    "tasks": (Task.id, "app_task_id", [
+        (Task.id, "app_task_id", "int"),
+        (Task.user_id, "app_user_id", "int"),
+        (Task.title, "title", "text"),
+        (Task.description, "description", "text"),
+        (Task.due_date, "due_date", "timestamp"),
+        (Task.priority, "priority", "int"),
+        (Task.completed, "completed", "bool"),
+    ]),
+    "reminders": (Reminder.id, "app_reminder_id", [
+        (Reminder.id, "app_reminder_id", "int"),
+        (Reminder.user_id, "app_user_id", "int"),
+        (Reminder.type, "type", "text"),
+        (Reminder.message, "message", "text"),
+        (Reminder.scheduled_time, "scheduled_time", "timestamp"),
+        (Reminder.repeat_interval, "repeat_interval", "int"),
+        (Reminder.active, "active", "bool"),
+    ]),
+}
+
+# Postgres expression giving the canonical text of a column of each kind
+_SQL_CANONICAL = {
+    "int": "{col}::text",
+    "text": "{col}::text",
+    "bool": "{col}::int::text",
+    "timestamp": "floor(extract(epoch from {col}))::bigint::text",
+}
+# Postgres expression for what a row adds to its bucket's sum
+_SQL_PREFIX = "('x' || substr({checksum}, 1, 15))::bit(60)::bigint"
+
+_reconciler = None
+_reconciler_lock = threading.Lock()
+_last_run = None
+
+
+def _checksum_sql(fields):
+    """Postgres md5 of a row's canonical text, for (column SQL, kind) pairs."""
+    row_text = ",\n           ".join(
+        f"coalesce({_SQL_CANONICAL[kind].format(col=column)}, E'\\\\N')" for column, kind in fields
+    )
+    return f"""md5(concat_ws(E'\\x1f',
+           {row_text}))"""
+
+
+def _table_sql(table, key, fields):
+    return f"""create or replace function reconcile_rows_{table}(lo bigint, hi bigint)
+returns table (key bigint, checksum text) language sql stable as $$
+  select {key}::bigint,
+         {_checksum_sql([(column, kind) for _, column, kind in fields])}
+  from {table}
+  where {key} >= lo and {key} < hi
+$$;
+
+create or replace function reconcile_buckets_{table}(lo bigint, hi bigint, bucket_size bigint)
+returns table (bucket bigint, row_count bigint, checksum text) language sql stable as $$
+  select key / bucket_size,
+         count(*),
+         sum({_SQL_PREFIX.format(checksum="checksum")})::text
+  from reconcile_rows_{table}(lo, hi)
+  group by 1
+$$;
+"""
+
+
+# Functions to create once in Supabase (SQL editor or a migration)
+RECONCILE_SQL = "\n".join(
+    _table_sql(table, key, fields) for table, (_, key, fields) in RECONCILED_TABLES.items()
+)
+
+
+def _canonical(value):
+    """Text form of a value matching _SQL_CANONICAL."""
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, datetime):
+        return str(calendar.timegm(value.timetuple()))
+    return str(value)
+
+
+def _row_checksum(row):
+    text = FIELD_SEPARATOR.join(_canonical(value) for value in row)
+    return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+
+def _local_checksum_sql(table):
+    """The local rows' md5 in Postgres SQL, the same expression Supabase runs."""
+    _, _, fields = RECONCILED_TABLES[table]
+    dialect = db.engine.dialect
+    return _checksum_sql([
+        (str(column.expression.compile(dialect=dialect)), kind) for column, _, kind in fields
+    ])
+
+
+def _local_query(table, lo, hi, *columns):
+    key, _, _ = RECONCILED_TABLES[table]
+    query = db.session.query(*columns).filter(key >= lo, key < hi)
+    if table == "users":
+        # Users without a Telegram ID are never replicated
+        query = query.filter(User.telegram_id.isnot(None))
+    return query
+
+
+def _local_rows(table, lo, hi):
+    """Yield (key, md5) for local rows with lo <= key < hi.
+
+    On Postgres the database computes the checksums; elsewhere rows are
+    streamed and hashed here.
+    """
+    key, _, fields = RECONCILED_TABLES[table]
+    if db.engine.dialect.name == "postgresql":
+        checksum = literal_column(_local_checksum_sql(table))
+        yield from _local_query(table, lo, hi, key, checksum).yield_per(1000)
+        return
+
+    for row in _local_query(table, lo, hi, *[column for column, _, _ in fields]).yield_per(1000):
+        yield row[0], _row_checksum(row)
+
+
+def _local_buckets(table, lo, hi, bucket_size):
+    """Return {bucket: (row_count, sum)} computed the same way as reconcile_buckets_*.
+
+    On Postgres the buckets are summed by the database with the same
+    expressions as Supabase, so only one row per bucket is read. Elsewhere
+    rows are streamed and folded as they arrive, so memory stays flat
+    however large the range is.
+    """
+    if db.engine.dialect.name == "postgresql":
+        key, _, _ = RECONCILED_TABLES[table]
+        bucket = cast(key, BigInteger) // bucket_size
+        total = func.sum(literal_column(_SQL_PREFIX.format(checksum=_local_checksum_sql(table))))
+        rows = _local_query(table, lo, hi, bucket, func.count(), total).group_by(bucket)
+        return {index: (count, int(summed)) for index, count, summed in rows}
+
+    buckets = {}
+    for key, checksum in _local_rows(table, lo, hi):
+        count, total = buckets.get(key // bucket_size, (0, 0))
+        buckets[key // bucket_size] = (count + 1, total + int(checksum[:15], 16))
+    return buckets
+
+
+def _remote_buckets(table, lo, hi, bucket_size):
+    data = get_supabase_client().rpc(
+        f"reconcile_buckets_{table}", {"lo": lo, "hi": hi, "bucket_size": bucket_size}
+    ).execute().data
+    return {row["bucket"]: (row["row_count"], int(row["checksum"])) for row in data}
+
+
+def _remote_checksums(table, lo, hi):
+    data = get_supabase_client().rpc(f"reconcile_rows_{table}", {"lo": lo, "hi": hi}).execute().data
+    return {row["key"]: row["checksum"] for row in data}
+
+
+def _repair(table, lo, hi, report, dry_run):
+    """Compare one leaf range row by row and push local rows that differ."""
+    local = dict(_local_rows(table, lo, hi))
+    remote = _remote_checksums(table, lo, hi)
+    changed = [key for key, checksum in local.items() if remote.get(key) != checksum]
+    extra = [key for key in remote if key not in local]
+    report["rows_upserted"] += len(changed)
+    report["rows_deleted"] += len(extra)
+    if dry_run:
+        return
+
+    if changed:
+        _, model, columns, build = next(spec for spec in REPLICATED_TABLES if spec[0] == table)
+        rows = db.session.query(*columns).filter(model.id.in_(changed)).all()
+        upsert_rows(table, [row for row in map(build, rows) if row], CONFLICT_KEYS[table])
+    if extra:
+        get_supabase_client().table(table).delete().in_(RECONCILED_TABLES[table][1], extra).execute()
+
+
+def _reconcile_range(table, lo, hi, bucket_size, report, dry_run):
+    """Compare bucket checksums over [lo, hi) and descend into the ones that differ."""
+    local_buckets = _local_buckets(table, lo, hi, bucket_size)
+    remote_buckets = _remote_buckets(table, lo, hi, bucket_size)
+    report["buckets_compared"] += len(set(local_buckets) | set(remote_buckets))
+
+    for bucket in set(local_buckets) | set(remote_buckets):
+        if local_buckets.get(bucket) == remote_buckets.get(bucket):
+            continue
+        report["buckets_mismatched"] += 1
+        bucket_lo = max(lo, bucket * bucket_size)
+        bucket_hi = min(hi, (bucket + 1) * bucket_size)
+        if bucket_size <= RECONCILE_LEAF_SIZE:
+            _repair(table, bucket_lo, bucket_hi, report, dry_run)
+        else:
+            _reconcile_range(
+                table, bucket_lo, bucket_hi, max(1, bucket_size // RECONCILE_FANOUT), report, dry_run
+            )
+
+
+def reconcile_table(table, dry_run=False):
+    """Find and repair rows where Supabase differs from the local table.
+
+    Both sides sum per-row md5 prefixes into buckets of ids; only buckets
+    whose count or sum differ are split and compared again, down to leaf
+    ranges that are compared row by row. Network traffic grows with the
+    amount of drift, not the table size. Needs the functions in
+    RECONCILE_SQL in Supabase. Must be called inside an app context.
+    """
+    report = {"buckets_compared": 0, "buckets_mismatched": 0, "rows_upserted": 0, "rows_deleted": 0}
+    _reconcile_range(table, 0, MAX_KEY, RECONCILE_TOP_BUCKET, report, dry_run)
+    logger.info(f"Reconciled {table} with Supabase: {report}")
+    return report
+
+
+def reconcile_all(dry_run=False):
+    """Reconcile every replicated table. Must be called inside an app context."""
+    return {table: reconcile_table(table, dry_run) for table in RECONCILED_TABLES}
+
+
+def _reconcile_in_background(dry_run):
+    global _last_run
+    from app import app
+
+    try:
+        with app.app_context():
+            tables = reconcile_all(dry_run)
+        outcome = {"tables": tables}
+    except Exception as e:
+        logger.error(f"Error reconciling with Supabase: {e}")
+        outcome = {"error": str(e)}
+    with _reconciler_lock:
+        _last_run = dict(_last_run, running=False, finished_at=datetime.utcnow().isoformat(), **outcome)
+
+
+def start_reconcile(dry_run=False):
+    """Start reconciling every table on a background thread.
+
+    Returns False without starting anything if this process is already
+    running one.
+    """
+    global _reconciler, _last_run
+
+    with _reconciler_lock:
+        if _reconciler is not None and _reconciler.is_alive():
+            return False
+        _last_run = {
+            "running": True,
+            "dry_run": dry_run,
+            "started_at": datetime.utcnow().isoformat(),
+            "finished_at": None,
+            "tables": None,
+            "error": None,
+        }
+        _reconciler = threading.Thread(
+            target=_reconcile_in_background, args=(dry_run,), name="supabase-reconcile", daemon=True
+        )
+        _reconciler.start()
+    logger.info(f"Supabase reconciliation started (dry_run={dry_run})")
+    return True
+
+
+def reconcile_status():
+    """Return this process's latest reconciliation run, or None if there hasn't been one."""
+    with _reconciler_lock:
+        return dict(_last_run) if _last_run else None
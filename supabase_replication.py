@@ -0,0 +1,162 @@
+import os
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import tuple_
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import User, Task, Reminder, SyncWatermark
+from leases import claim_rows
+from supabase_client import (
+    SUPABASE_URL, CONFLICT_KEYS, user_row, task_row, reminder_row, upsert_rows
+)
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+REPLICATION_INTERVAL_SECONDS = int(os.environ.get("SUPABASE_REPLICATION_INTERVAL_SECONDS", 60))
+REPLICATION_CHUNK_SIZE = int(os.environ.get("SUPABASE_REPLICATION_CHUNK_SIZE", 1000))
+# Chunks per table per run; a large backlog is worked off over several runs
+REPLICATION_MAX_CHUNKS = int(os.environ.get("SUPABASE_REPLICATION_MAX_CHUNKS", 50))
+# Rows stamped this recently are left for the next run, so a transaction that
+# set updated_at but hadn't committed yet isn't skipped past
+REPLICATION_LAG_SECONDS = 30
+REPLICATION_LEASE_SECONDS = REPLICATION_INTERVAL_SECONDS * 5
+
+# (Supabase table, model, columns to read, row builder). Users without a
+# Telegram ID are skipped since telegram_id is their upsert key.
+REPLICATED_TABLES = [
+    (
+        "users", User,
+        (User.id, User.updated_at, User.telegram_id, User.email, User.username),
+        lambda r: user_row(r.id, r.telegram_id, r.email, r.username) if r.telegram_id else None
+    ),
+    (
+        "tasks", Task,
+        (Task.id, Task.updated_at, Task.user_id, Task.title, Task.description, Task.due_date,
+         Task.priority, Task.completed),
+        lambda r: task_row(r.id, r.user_id, r.title, r.description, r.due_date, r.priority, r.completed)
+    ),
+    (
+        "reminders", Reminder,
+        (Reminder.id, Reminder.updated_at, Reminder.user_id, Reminder.type, Reminder.message,
+         Reminder.scheduled_time, Reminder.repeat_interval, Reminder.active),
+        lambda r: reminder_row(r.id, r.user_id, r.type, r.message, r.scheduled_time,
+                               r.repeat_interval, r.active)
+    ),
+]
+
+_replicator = None
+_replicator_lock = threading.Lock()
+
+
+def _ensure_watermarks():
+    """Create a watermark row for every replicated table that lacks one."""
+    existing = {name for (name,) in db.session.query(SyncWatermark.name)}
+    missing = [table for table, *_ in REPLICATED_TABLES if table not in existing]
+    if not missing:
+        return
+
+    db.session.add_all([SyncWatermark(name=name, last_id=0) for name in missing])
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another process created them first
+        db.session.rollback()
+
+
+def replicate_table(table, model, columns, build):
+    """Copy rows changed since the table's watermark to Supabase.
+
+    Rows are read in (updated_at, id) order with keyset pagination, so each
+    chunk is an index range scan no matter how many rows the table has, and
+    upserted in bulk. The watermark is committed after every chunk, so an
+    interrupted run resumes where it stopped. Rows whose updated_at is NULL
+    (from before the column existed) need a backfill to be picked up.
+    Must be called inside an app context. Returns the number of rows copied.
+    """
+    ids = claim_rows(
+        SyncWatermark,
+        [SyncWatermark.name == table],
+        SyncWatermark.id,
+        1,
+        lease_seconds=REPLICATION_LEASE_SECONDS
+    )
+    if not ids:
+        # Another process is replicating this table
+        return 0
+
+    watermark = db.session.get(SyncWatermark, ids[0])
+    cutoff = datetime.utcnow() - timedelta(seconds=REPLICATION_LAG_SECONDS)
+    copied = 0
+    try:
+        for _ in range(REPLICATION_MAX_CHUNKS):
+            query = db.session.query(*columns).filter(model.updated_at <= cutoff)
+            if watermark.updated_at is not None:
+                query = query.filter(
+                    tuple_(model.updated_at, model.id) > tuple_(watermark.updated_at, watermark.last_id)
+                )
+            rows = query.order_by(model.updated_at, model.id).limit(REPLICATION_CHUNK_SIZE).all()
+            if not rows:
+                break
+
+            upsert_rows(table, [row for row in map(build, rows) if row], CONFLICT_KEYS[table])
+
+            watermark.updated_at = rows[-1].updated_at
+            watermark.last_id = rows[-1].id
+            watermark.synced_at = datetime.utcnow()
+            db.session.commit()
+            copied += len(rows)
+
+            if len(rows) < REPLICATION_CHUNK_SIZE:
+                break
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error replicating {table} to Supabase: {e}")
+    finally:
+        watermark.lease_owner = None
+        watermark.lease_expires_at = None
+        db.session.commit()
+
+    return copied
+
+
+def replicate_all():
+    """Run one replication pass over every table. Must be called inside an app context."""
+    _ensure_watermarks()
+    copied = 0
+    for table, model, columns, build in REPLICATED_TABLES:
+        count = replicate_table(table, model, columns, build)
+        if count:
+            logger.info(f"Replicated {count} {table} to Supabase")
+        copied += count
+    return copied
+
+
+def _replicate_forever():
+    from app import app
+
+    while True:
+        try:
+            with app.app_context():
+                replicate_all()
+        except Exception as e:
+            logger.error(f"Error in Supabase replication: {e}")
+        time.sleep(REPLICATION_INTERVAL_SECONDS)
+
+
+def start_replication():
+    """Start the background thread that replicates changed rows to Supabase."""
+    global _replicator
+
+    if not SUPABASE_URL or _replicator is not None:
+        return
+    with _replicator_lock:
+        if _replicator is None:
+            _replicator = threading.Thread(target=_replicate_forever, name="supabase-replication", daemon=True)
+            _replicator.start()
+            logger.info("Supabase replication started")
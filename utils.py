@@ -1,5 +1,7 @@
 import os
 import logging
+import threading
+import time
 from datetime import datetime, timedelta
 
 # Configure logging
@@ -174,3 +176,116 @@ def format_telegram_message(text, entities=None):
             result = result[:start] + f"`{entity_text}`" + result[end:]
         
     return result
+
+
+class TokenBucket:
+    """Thread-safe token bucket for rate limiting.
+    
+    reserve() takes a token right away, letting the balance go negative, and
+    returns how long the caller has to wait before using it. Reservations
+    queue up in order, so callers can sleep with time.sleep or asyncio.sleep.
+    """
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def reserve(self, tokens=1):
+        """Take tokens and return the seconds to wait before they are available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+    
+    def idle(self):
+        """Return True if the bucket has refilled completely."""
+        with self._lock:
+            elapsed = time.monotonic() - self._updated
+            return self._tokens + elapsed * self.rate >= self.capacity
+
+
+class CircuitBreaker:
+    """Thread-safe circuit breaker for calls to a flaky dependency.
+    
+    After `failure_threshold` consecutive failures the breaker opens and
+    allow() returns False without the call being made. Once `reset_timeout`
+    seconds have passed it goes half-open and lets `half_open_calls` probe
+    calls through: a success closes it again, a failure reopens it.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, half_open_calls=1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = float(reset_timeout)
+        self.half_open_calls = half_open_calls
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._trips = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+    
+    def _refresh(self, now):
+        if self._state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+    
+    @property
+    def state(self):
+        with self._lock:
+            self._refresh(time.monotonic())
+            return self._state
+    
+    def retry_in(self):
+        """Seconds until an open breaker lets a probe through, 0 if it would now."""
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+    
+    def allow(self):
+        """Return True if a call may be made now; counts a probe when half-open."""
+        with self._lock:
+            self._refresh(time.monotonic())
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return True
+            self._rejected += 1
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+    
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self._trips += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+    
+    def metrics(self):
+        with self._lock:
+            self._refresh(time.monotonic())
+            return {
+                "state": self._state,
+                "consecutive_failures": self._failures,
+                "trips": self._trips,
+                "rejected": self._rejected,
+            }